@@ -7,6 +7,8 @@ import argparse
 import getpass
 import base64
 import copy
+import imp
+import time
 
 sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'simperium-python'))
 
@@ -17,6 +19,54 @@ APP_ID   = 'chalk-bump-f49'
 API_KEY  = base64.b64decode('YzhjMmI4NjMzNzE1NGNkYWJjOTg5YjIzZTMwYzZiZjQ=')
 BUCKET   = 'note'
 
+def probe(token, limits, pages):
+    """Download the first few index pages for each limit, and print how long
+    they took and how big they were.
+
+    Requests go through simplenote-backup's own bucket class, so they are
+    made as sync makes them: over one kept-open connection, with gzip.
+    """
+    sn_backup = imp.load_source(
+        'simplenote_backup',
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), 'simplenote-backup.py'))
+    def reauth(old_token, err):
+        raise err
+    metrics = sn_backup.Metrics()
+    bucket = sn_backup.AuthRetryBucket(APP_ID, token, BUCKET, reauth=reauth,
+                                       metrics=metrics)
+
+    print('Connection is kept open between pages, as in simplenote-backup.')
+    print('wire KB is as received (gzip); text KB is note text, which '
+          'index-page-bytes limits.')
+    print('%6s %5s %6s %8s %9s %9s %9s' % (
+            'limit', 'page', 'notes', 'sec', 'wire KB', 'text KB', 'notes/s'))
+    for limit in limits:
+        mark = None
+        total_notes, total_wire, total_text, total_time = 0, 0, 0, 0.0
+        for page in range(pages):
+            wire_before = metrics.counters.get('bytes_downloaded', 0)
+            start = time.time()
+            resp = bucket.index(data=True, mark=mark, limit=limit)
+            elapsed = max(time.time() - start, 1e-6)
+            wire = metrics.counters.get('bytes_downloaded', 0) - wire_before
+            text = sum(len(item['d'].get('content', ''))
+                       for item in resp['index'])
+            notes = len(resp['index'])
+            total_notes += notes
+            total_wire += wire
+            total_text += text
+            total_time += elapsed
+            print('%6d %5d %6d %8.3f %9.1f %9.1f %9.1f' % (
+                    limit, page, notes, elapsed, wire / 1024.0,
+                    text / 1024.0, notes / elapsed))
+            mark = resp.get('mark')
+            if mark is None:
+                break
+        print('%6d %5s %6d %8.3f %9.1f %9.1f %9.1f' % (
+                limit, 'all', total_notes, total_time, total_wire / 1024.0,
+                total_text / 1024.0, total_notes / total_time))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -29,6 +79,15 @@ def main():
     parser.add_argument(
         '-t', '--token', metavar='TOKEN',
         help='Use existing token')
+
+    parser.add_argument(
+        '--probe', metavar='LIMITS',
+        help='Time index downloads with each of the comma-separated page '
+        'sizes (for example 20,100,500) instead of printing notes')
+    parser.add_argument(
+        '--pages', type=int, default=3,
+        help='With --probe, number of pages to download per size '
+        '(default %(default)s)')
     
     args = parser.parse_args()
 
@@ -51,6 +110,14 @@ def main():
                 
     #print('buckets', bucket._request('%s/buckets' % APP_ID))
 
+    if args.probe:
+        try:
+            limits = [int(x) for x in args.probe.split(',')]
+        except ValueError:
+            parser.error('--probe wants comma-separated numbers')
+        probe(token, limits, args.pages)
+        return
+
     resp = bucket.index(data=True, limit=5)
     index = resp.pop('index')
     print('Result meta: %r' % (resp, ))
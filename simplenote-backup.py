@@ -19,26 +19,175 @@ token-cache-file specifies where the token will be cached. If the token is prese
 and valid, then username/password are not required. The token will be updated 
 automatically as needed.
 
+Optional settings in the same section:
+  incremental = yes
+  full-sync-hours = 24
+
+If incremental is set, the change cursor of the last successful run is kept in
+data-dir/.simplenote-backup/ and the next run only downloads notes changed
+since then. Notes purged from the trash are not reported by such a sync, so a
+full index download is still done every full-sync-hours (and whenever the
+cursor is rejected or the data dir looks damaged).
+
+Before downloading all the notes, the program gets the version numbers only.
+If at most fetch-threshold notes (default 100) have changed, just those are
+fetched, using fetch-threads (default 8) parallel requests. Set
+fetch-threshold = 0 to always download everything.
+
+The full index is downloaded in pages of the server's default size. Set
+index-page-size to ask for a fixed number of notes per page, or to "auto" to
+adjust it after each page, within index-page-min and index-page-max (default
+20 and 1000): pages grow while they take less than index-page-time seconds
+(default 2) and hold less than index-page-bytes of note text (default
+4000000), and shrink when they take longer or hold more. Use
+"simperium-test.py --probe" to see how the page size affects speed.
+
+Failed index and note requests are retried request-retries times (default
+4), waiting longer each time. If the download still fails, the notes
+written so far are kept, together with the position in the index, and the
+next run continues from there rather than downloading everything again.
+
+The same directory holds a manifest of all note files, so that startup does
+not need to read every .json file. It is only trusted while the files and
+directories have the same mtime/size as recorded; use --rescan to ignore it.
+
+Only the size of note files is checked on startup. With --verify, their md5
+is checked as well, using all CPUs; a file which still has the mtime/size it
+had when it was last found good is skipped. Use --verify-all every so often
+to check all the files. Damaged notes are downloaded again.
+
+Note files are written to temp files and renamed into place, and synced to
+disk in batches. write-threads (default 8) threads write them. Set fsync =
+no to skip the syncs (for example, on storage which is slow to sync and
+backed up elsewhere). Each file and changed directory is synced separately;
+on Linux, syncfs = yes syncs the whole filesystem twice per batch instead,
+which is faster on a data dir of its own, but also flushes everything else
+written to that filesystem.
+
+For testing, simperium-api-host, simperium-auth-host and simperium-scheme
+point the program to another server (see simplenote-bench.py).
+
 The program can be set up to use 'git' to maintain the version history. Set it
 up, add to your crontab, and you can have the permanent history of all your
 notes. Even if the someone hacks the account and deletes everything, or if
 the servers go down, it is still all in the history on your local pc!
 
+To put the notes back into the account, use "restore" (or "restore GIT-REV"
+for the notes as of an older commit). Notes which are on the server and not
+in trash are left alone; the rest are uploaded with restore-threads (default
+8) parallel requests, slowing down whenever the server asks to. If
+interrupted, run the same command again to continue.
+
+With storage = sqlite, all notes are kept in one file, data-dir/notes.sqlite,
+rather than as a .txt and a .json file per note. This is much faster with
+many thousands of notes. It cannot be used with git (-g): git would store
+a new copy of the whole file on every run with changes; use history = yes
+to keep old versions instead. Use --export DIR to get the usual files from
+it. Start with an empty data-dir when changing the storage.
+
+With history = yes, older versions of the notes are downloaded too, up to
+history-versions (default 30) per note, and kept compressed in
+data-dir/.simplenote-backup/history.sqlite (or history-file). Each version
+is only downloaded once.
+
+With search-index = yes, a full-text index of the notes is kept in
+data-dir/.simplenote-backup/search.sqlite, and updated with the changed notes
+on each run. Query it with "search QUERY", where QUERY is in SQLite FTS5
+syntax: words, "phrases", prefix*, OR, NOT, and columns filename:, tags:,
+created:, modified:, content:.
+
+To check an Evernote export against the backup, use "compare EVERNOTE-DIR
+[SIMPLENOTE-DIR]" (default is data-dir). Each EVERNOTE-DIR/*/*.stxt is
+compared with the .txt of the same name in SIMPLENOTE-DIR, loosely: only the
+words matter, not whitespace or line breaks, and the title lines are
+skipped. Prints MISSING or SAME for each, or a diff of the words. Word lists
+are remembered, so unchanged files are not read again.
+
+With journal = yes, each change is also appended to
+data-dir/.simplenote-backup/journal (or journal-file), for other programs
+which need to know what changed. Each line is a json array:
+  [seq, time, op, key, version, md5, filename, old filename]
+where op is add, mod, mv or del; old filename is set if the note's files
+were renamed. seq grows by one per line: run "journal SEQ" to print the
+lines after SEQ. Lines are written before the notes they describe, so a
+change may be listed twice, but not missed; if a run was interrupted, a
+rescan line tells readers to look at all the notes.
+
+With --metrics-json / --metrics-prom (or metrics-json / metrics-prom in the
+config), time spent in each phase and counters such as bytes downloaded and
+files written are saved at the end of each run, as JSON or as a file for
+Prometheus node_exporter's textfile collector.
+
+To back up several accounts, list them in one file and use --accounts FILE:
+  [simplenote-backup]
+  jobs = 4
+  incremental = yes
+
+  [account alice]
+  sn_username = alice@email.com
+  sn_password = passw0rd
+  data-dir = ~/backup/alice
+  token-cache-file = ~/.sn-tokens/alice
+
+Options in [simplenote-backup] apply to all accounts, and each account may
+override them. data-dir, token-cache-file, metrics-json, metrics-prom,
+journal-file and history-file can only be set per account, and no two
+accounts may use the same file. Up to jobs accounts (or --jobs) are backed
+up at once, each in its own process with its own lock; a failure of one
+does not stop others. The exit status is non-zero if any account failed.
+
+With --daemon, the program keeps running and waits on the server's change
+feed. Changes are written (and committed, with -g) once there were no more
+edits for daemon-debounce seconds (default 10), so a burst of edits ends up
+in one commit.
+
+If the data dir is locked by another run, the program fails with exit status
+2. With --wait SECONDS (or lock-wait in config), it waits up to that long
+for the other run to finish instead, so that a slow run does not cause the
+next cron run to be lost. Only one run waits at a time: if there is one
+already, the program exits with status 0 at once, as the waiting run will
+get the changes anyway.
+
+By default, commits only look at the files changed by this run (git-mode =
+fast). If the repo was changed by someone else, or the last run did not
+commit, the program falls back to 'git add --all'; set git-mode = porcelain
+to always do that.
+
 """
 
+import collections
 import ConfigParser
+import contextlib
+import ctypes
+import ctypes.util
 import errno
+import difflib
 import fcntl
+import glob
 import hashlib
+import httplib
+import itertools
 import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import optparse
 import os
+import Queue
+import StringIO
 import re
 import subprocess
 import sys
 import socket
+import sqlite3
+import threading
 import time
+import traceback
+import urllib
 import urllib2
+import urlparse
+import uuid
+import zlib
 
 import base64
 
@@ -55,22 +204,143 @@ BUCKET   = 'note'
 class OutputBusyError(Exception):
     pass
 
+class RunQueuedError(OutputBusyError):
+    """Data dir is busy, and another run is already waiting for it. That
+    run will sync once the dir is free, so this is not a failure."""
+    pass
+
 MAGIC_NAME = 'simplenote-backup'
 
+# directory (inside data dir) for our own bookkeeping files. Not a part of
+# the backup, ignored by the scanner and by git.
+STATE_DIR_NAME = '.simplenote-backup'
+
+# default interval between full syncs in incremental mode
+FULL_SYNC_HOURS = 24
+
+# fetch notes one by one if at most this many have changed. Otherwise,
+# download the full index with data.
+FETCH_THRESHOLD = 100
+# number of parallel requests when fetching notes
+FETCH_THREADS = 8
+# number of fetched notes to process at once
+FETCH_PAGE_SIZE = 100
+
+# index-page-size = auto: bounds for the number of notes per index page,
+# and the longest time and most note text a page should take
+INDEX_PAGE_MIN = 20
+INDEX_PAGE_MAX = 1000
+INDEX_PAGE_TIME = 2.0
+INDEX_PAGE_BYTES = 4000000
+
+# index and fetch requests which fail with network or server errors are
+# retried this many times, the delay before each retry doubled
+REQUEST_RETRIES = 4
+REQUEST_RETRY_DELAY = 2
+# while downloading the index, save progress at most this often (seconds),
+# so an interrupted sync can continue from there
+CHECKPOINT_INTERVAL = 60
+
+# restore: number of parallel uploads
+RESTORE_THREADS = 8
+# restore: notes read and uploaded at once, progress is saved after each
+RESTORE_BATCH_SIZE = 500
+# restore: longest wait between requests when server limits our rate
+RESTORE_MAX_DELAY = 60
+
+# daemon mode: sync once there were no changes for this many seconds
+DAEMON_DEBOUNCE = 10
+# ...but do not wait longer than this after the first change
+DAEMON_MAX_DELAY = 60
+# ...and sync every so often even if there were no changes
+DAEMON_IDLE_TIME = 3600
+# least time between polls of the change feed, in case the server (or a
+# proxy) returns without waiting
+DAEMON_MIN_POLL = 2
+# delay after network errors, doubled each time
+DAEMON_RETRY_DELAY = 10
+DAEMON_MAX_RETRY_DELAY = 600
+
+# number of files to write before syncing them to disk
+WRITE_BATCH_SIZE = 256
+# number of threads writing note files
+WRITE_THREADS = 8
+
+# version of the manifest.json format in the state dir
+MANIFEST_FORMAT = 1
+
+# with storage = sqlite, all the notes are in this file inside data dir
+SQLITE_NAME = 'notes.sqlite'
+
+# with history = yes, how many versions back to archive, per note
+HISTORY_VERSIONS = 30
+
+# max number of notes printed by search command
+SEARCH_LIMIT = 20
+
+# journal: bytes read from the end to find the last line
+JOURNAL_TAIL_SIZE = 65536
+
+# compare command: number of file pairs given to a worker process at once
+COMPARE_CHUNK_SIZE = 32
+
+# with lock-wait, how often to check if the data dir is free (seconds)
+LOCK_POLL_INTERVAL = 1
+
+# multi-account mode: number of accounts to back up at once
+ACCOUNT_JOBS = 4
+# options of account sections which go to nvpy section
+ACCOUNT_NVPY_OPTIONS = ('sn_username', 'sn_password')
+# options naming files of one account, which accounts must not share
+ACCOUNT_OWN_OPTIONS = ('data-dir', 'token-cache-file', 'metrics-json',
+                       'metrics-prom', 'journal-file', 'history-file')
+
+class NoteRecord(object):
+    """What we keep in memory about a stored note.
+
+    There is one for every note, so only bookkeeping fields are here. Full
+    metadata is only loaded for notes which changed, and only while they
+    are being written. version and content_len are None if the stored
+    note is damaged, so it gets downloaded again.
+
+    txt_stat and json_stat are (mtime, size) of the note files, used to
+    write the manifest without re-stating unchanged files; None if not
+    known yet.
+    """
+    __slots__ = ('key', 'version', 'filename', 'content_len', 'content_md5',
+                 'txt_stat', 'json_stat')
+
+    def __init__(self, key, version, filename, content_len, content_md5,
+                 txt_stat=None, json_stat=None):
+        self.key = key
+        self.version = version
+        # no extension, .txt and .json are added
+        self.filename = filename
+        self.content_len = content_len
+        self.content_md5 = content_md5
+        self.txt_stat = txt_stat
+        self.json_stat = json_stat
+
+
 class SimplenoteDownloader(object):
     def __init__(self, extra_config=None, verbose=0,
-                 data_dir=None):
+                 data_dir=None, rescan=False, config=None, log_prefix='',
+                 verify=None, lock_wait=None):
         self._api_bucket = None  # simperium "bucket" object
         self._lockfile = None
         self._lockfile_name = None
         self._config = None
         self._token_cache_file = None
+        self._auth_lock = threading.Lock()
         self.verbose = verbose
-        self._read_config(extra_config)
-        self._make_syncer()
-
-        # on-disk/cached entries, keyed by id.
-        # 'content' should be missing
+        self.log_prefix = log_prefix
+        self.metrics = Metrics()
+        with self.metrics.phase('config'):
+            self._read_config(extra_config, config)
+        with self.metrics.phase('token'):
+            self._make_syncer()
+
+        # NoteRecord of on-disk/cached entries, keyed by id.
         # updated by _read_existing_files, write_files
         # not modified by sync()
         self.entries = None
@@ -79,15 +349,31 @@ class SimplenoteDownloader(object):
         # updated by sync(), cleared by write_files/_read_existing_files()
         self.updated = None
 
-        # Set of all the files in the system
-        # used to delete unused files.
+        # Set of files found on disk which do not belong to any entry
+        # (junk, or old files of a note which is in entries under another
+        # name). Files of entries are known from entries themselves.
+        # deleted as orphans by write_files()
         # updated by _read_existing_files()
-        self.all_files = None
+        self._extra_files = set()
+
+        # Names (no extension) which entries had at the start of the run,
+        # and which their notes left. Files left under them are deleted as
+        # orphans.
+        # set by _write_begin(), updated by _write_entry()
+        self._vacated_names = set()
 
         # list of tuples (type, name) of all changes
         # updated by write_files()
         self.changes = list()
 
+        # set of all files (relative to data_dir) written or removed
+        # updated by write_files(), used by maybe_checkin_to_git()
+        self.changed_files = set()
+
+        # contents of git.json at the start of write, if it was valid
+        # set by write_files(), used by maybe_checkin_to_git()
+        self._git_state = None
+
         # where the files are
         self.data_dir = data_dir
         if self.data_dir is None:
@@ -100,10 +386,97 @@ class SimplenoteDownloader(object):
         # flag: ignore entries in trash?
         self.ignore_deleted = True
 
+        # flag: use saved change cursor to only download changed notes?
+        self.incremental = self._option('incremental', False, 'getboolean')
+
+        # cursor info to be saved once the files are written
+        # set by sync(), used by write_files()
+        self._new_cursor = None
+
+        # versions of notes in trash (which are not saved), keyed by id
+        # loaded by _open_index(), updated by sync(), saved by write_files()
+        self._trash = None
+
+        # writer for note files
+        # set by _write_begin(), used until _write_finish()
+        self._writer = None
+
+        # thread pool running the writes, their AsyncResults in order, and
+        # how many may be queued
+        # set by _write_begin(), used until _write_finish()
+        self._write_pool = None
+        self._write_jobs = collections.deque()
+        self._max_write_jobs = None
+
+        # filenames (no extension) in use while writing
+        # set by _write_begin(), used until _write_finish()
+        self._gen_filenames = None
+
+        # dirs which notes were moved out of, to remove if empty
+        # set by _write_begin(), used until _write_finish()
+        self._vacated_dirs = None
+
+        # number of problems found by _read_existing_files. If any, we
+        # cannot trust incremental sync and must do a full one.
+        self._n_damaged = 0
+
+        # SqliteStore, if notes are stored in one file rather than in
+        # .txt/.json files. Opened by _init_datadir().
+        self._db = None
+        self.storage = self._option('storage', 'files')
+        if self.storage not in ('files', 'sqlite'):
+            raise Exception('Unknown storage %r, want files or sqlite' % (
+                    self.storage, ))
+
+        # HistoryArchive of older versions of notes, if enabled.
+        # Opened by _init_datadir().
+        self._history = None
+
+        # SearchIndex of notes, if enabled. Opened by _init_datadir().
+        self._search = None
+
+        # Journal of changes, if enabled. Opened by _init_datadir().
+        self._journal = None
+        # records to append to it on next flush
+        # set by _write_begin(), used until _write_finish()
+        self._journal_records = []
+
+        # where to write metrics at the end of the run, if anywhere
+        self.metrics_json = self._option('metrics-json')
+        self.metrics_prom = self._option('metrics-prom')
+
+        # seconds to wait if the data dir is locked by another run
+        if lock_wait is None:
+            lock_wait = self._option('lock-wait', 0, 'getfloat')
+        self.lock_wait = lock_wait
+
         # verify datadir, get lock
         self._init_datadir()
 
-        self._read_existing_files()
+        with self.metrics.phase('read_existing'):
+            self._read_entries(rescan)
+        # 'changed' or 'all'
+        if verify is not None:
+            with self.metrics.phase('verify'):
+                self._verify(verify == 'all')
+
+    def close(self):
+        """Release the data dir lock"""
+        if self._write_pool is not None:
+            self._write_pool.terminate()
+            self._write_pool = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+        if self._search is not None:
+            self._search.close()
+            self._search = None
+        if self._lockfile is not None:
+            self._lockfile.close()
+            self._lockfile = None
 
     def log(self, level, msg):
         """Log levels:
@@ -113,30 +486,30 @@ class SimplenoteDownloader(object):
          3 - debug details
         """
         if level <= self.verbose:
-            print >>sys.stderr, '>' + '*'*level, msg
-
-    def _read_config(self, extra_config):
-        self._config = ConfigParser.SafeConfigParser()
-        home = os.path.abspath(os.path.expanduser('~'))
-
-        # later config files overwrite earlier files
-        # try a number of alternatives
-        # This list is copied from nvpy: /nvpy/nvpy.py
-        configs = [
-                os.path.join(home, '.simplenote-backup.cfg'),
-                os.path.join(home, 'nvpy.cfg'),
-                os.path.join(home, '.nvpy.cfg'),
-                os.path.join(home, '.nvpy'),
-                os.path.join(home, '.nvpyrc') ]
-        if extra_config is not None:
-            configs.append(extra_config)
-        names = self._config.read(configs)
-        self.log(2, 'Read config files: %r' % names)
+            # one string, so lines from parallel accounts do not get mixed
+            print >>sys.stderr, '>%s %s%s' % ('*'*level, self.log_prefix, msg)
+
+    def _read_config(self, extra_config, config=None):
+        if config is not None:
+            # already prepared by caller (multi-account mode)
+            self._config = config
+        else:
+            self._read_config_files(extra_config)
 
         self.sn_username = self._config.get('nvpy', 'sn_username', raw=True)
         if not self.sn_username:
             raise Exception('sn_username missing in config file, please set it.')
 
+    def _read_config_files(self, extra_config):
+        self._config, names = read_config(extra_config)
+        self.log(2, 'Read config files: %r' % names)
+
+    def _option(self, name, default=None, getter='get'):
+        """Get option from our config section, or default if missing"""
+        if not self._config.has_option('simplenote-backup', name):
+            return default
+        return getattr(self._config, getter)('simplenote-backup', name)
+
     def _make_syncer(self):
         try:
             self._token_cache_file = os.path.expanduser(self._config.get('simplenote-backup', 'token-cache-file'))
@@ -152,35 +525,56 @@ class SimplenoteDownloader(object):
             token = None
             self.log(1, 'No token cache file found: %s' % (e, ))
 
-        # Verify token
-        if token is not None:
-            self._api_bucket = simperium.core.Api(APP_ID, token)[BUCKET]
-            try:
-                self._api_bucket.index(limit=1)
-                self.log(2, 'Using stored token')
-                return
-            except urllib2.HTTPError as err:
-                self.log(0, 'Token invalid, refreshing: %s' % (err, ))
-            
-        # If we are here, we need a new token                
+        # The token is not verified here: if it has expired, the first
+        # request will fail, and the bucket will call _reauthorize.
+        if token is None:
+            token = self._authorize()
+        else:
+            self.log(2, 'Using stored token')
+        self._api_bucket = AuthRetryBucket(APP_ID, token, BUCKET,
+                                           reauth=self._reauthorize,
+                                           metrics=self.metrics,
+                                           **self._server_options('api'))
+
+    def _server_options(self, kind):
+        """Host/scheme arguments for simperium Auth ('auth') or Bucket ('api')"""
+        kwargs = dict()
+        host = self._option('simperium-%s-host' % kind)
+        if host:
+            kwargs['host'] = host
+        scheme = self._option('simperium-scheme')
+        if scheme:
+            kwargs['scheme'] = scheme
+        return kwargs
+
+    def _authorize(self):
+        """Get a new token using password, store it in cache file"""
         sn_password = self._config.get('nvpy', 'sn_password', raw=True)
 
         if not sn_password:
             raise Exception('Cannot sync -- no password defined, and no stored token. '
                             'Make sure "nvpy" works')
         
-        auth = simperium.core.Auth(APP_ID, API_KEY)
+        auth = simperium.core.Auth(APP_ID, API_KEY, **self._server_options('auth'))
         token = auth.authorize(self.sn_username, sn_password)
         self.log(1, 'Authorization successful, storing token')
         try:
-            os.makedirs(os.dirname(self._token_cache_file))
+            os.makedirs(os.path.dirname(self._token_cache_file))
         except:
             pass
         with open(self._token_cache_file, 'w') as f:
             print >>f, token
             print >>f, 'fetch_date=%s' % time.strftime('%FT%TZ', time.gmtime())
+        return token
 
-        self._api_bucket = simperium.core.Api(APP_ID, token)[BUCKET]
+    def _reauthorize(self, old_token, err):
+        """Called by bucket when token was refused. Returns new token"""
+        with self._auth_lock:
+            # other thread might have done it already
+            if self._api_bucket.auth_token != old_token:
+                return self._api_bucket.auth_token
+            self.log(0, 'Token invalid, refreshing: %s' % (err, ))
+            return self._authorize()
 
     def _init_datadir(self):
         assert os.path.isdir(self.data_dir), 'Cannot find data directory %r' % (
@@ -203,34 +597,221 @@ class SimplenoteDownloader(object):
                     self._lockfile_name, self.sn_username, contents))
 
         # lock
+        if not _try_lock(self._lockfile):
+            if not self.lock_wait:
+                raise OutputBusyError(
+                    "Another instance is already running "
+                    "-- failed to get lock")
+            self._wait_for_lock()
+
+        self._make_state_dir()
+
+        if self.storage == 'sqlite':
+            self._db = SqliteStore(os.path.join(self.data_dir, SQLITE_NAME),
+                                   fsync=self._option('fsync', True, 'getboolean'))
+
+        if self._option('history', False, 'getboolean'):
+            self._history = HistoryArchive(os.path.expanduser(
+                    self._option('history-file', self._state_file('history.sqlite'))))
+
+        if self._option('search-index', False, 'getboolean'):
+            self._search = SearchIndex(self._state_file('search.sqlite'))
+
+        if self._option('journal', False, 'getboolean'):
+            self._journal = Journal(
+                os.path.expanduser(self._option('journal-file',
+                                                self._state_file('journal'))),
+                fsync=self._option('fsync', True, 'getboolean'))
+
+    def _wait_for_lock(self):
+        """Wait up to lock_wait seconds for the data dir lock.
+
+        Waiting runs take waiting.lock in state dir, so there is only one.
+        It is released once the data dir lock is ours, so another run can
+        wait while this one syncs.
+        """
+        self._make_state_dir()
+        with open(self._state_file('waiting.lock'), 'a') as waiting:
+            if not _try_lock(waiting):
+                raise RunQueuedError(
+                    "Another instance is running, and another one is "
+                    "waiting to run after it")
+            self.log(1, 'Another instance is running, waiting for it to finish')
+            deadline = time.time() + self.lock_wait
+            while not _try_lock(self._lockfile):
+                if time.time() >= deadline:
+                    raise OutputBusyError(
+                        "Another instance is still running after %d sec "
+                        "-- failed to get lock" % self.lock_wait)
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def _make_state_dir(self):
+        _make_state_dir(self.data_dir)
+
+    def _state_file(self, name):
+        return os.path.join(self.data_dir, STATE_DIR_NAME, name)
+
+    def _load_state(self, name, default=None):
+        """Load json object from state dir. Returns default if missing or bad"""
         try:
-            fcntl.lockf(self._lockfile.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            with open(self._state_file(name), 'r') as f:
+                return json.load(f)
         except IOError as e:
-            if e.errno != errno.EAGAIN:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError as e:
+            self.log(0, 'State file %r corrupt, ignoring: %s' % (name, e))
+        return default
+
+    def _save_state(self, name, value):
+        """Atomically replace json object in state dir"""
+        fullname = self._state_file(name)
+        with open(fullname + '.tmp', 'w') as f:
+            json.dump(value, f, sort_keys=True, separators=(',', ':'))
+        os.rename(fullname + '.tmp', fullname)
+
+    def _remove_state(self, name):
+        try:
+            os.remove(self._state_file(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
                 raise
-            raise OutputBusyError(
-                "Another instance is already running "
-                "-- failed to get lock")
 
 
+    def _read_entries(self, rescan=False):
+        """Load entries of notes we have, from whichever storage is used"""
+        if self._db is not None:
+            self._read_db(verify=rescan)
+        elif rescan or not self._read_manifest():
+            self._read_existing_files()
+
+    def _read_db(self, verify):
+        """Load entries from sqlite storage.
+
+        With verify, re-read all contents and check them against the
+        recorded length and md5.
+        """
+        self.entries = dict()
+        self.updated = dict()
+        # there are no note files, so nothing to delete as orphans
+        self._extra_files = set()
+        for key, version, filename, content_len, content_md5 in \
+                self._db.iter_entries():
+            self.entries[key] = NoteRecord(key, version, filename,
+                                           content_len, content_md5)
+        if verify:
+            self._verify_db()
+        self.log(2, 'Read %d entries from %r' % (len(self.entries), SQLITE_NAME))
+
+    def _verify_db(self):
+        """Check all contents in sqlite storage against the recorded
+        length and md5"""
+        for key, content in self._db.iter_contents():
+            entry = self.entries[key]
+            if (len(content) != entry.content_len or
+                hashlib.md5(content).hexdigest() != entry.content_md5):
+                self.log(0, 'Note %r damaged in %r' % (key, SQLITE_NAME))
+                # break stuff to force re-sync
+                entry.version = None
+                self._n_damaged += 1
+
+    def _read_manifest(self):
+        """Load entries from the manifest written by the last run.
+
+        The manifest is only trusted if all the directories and note files
+        still have the recorded mtime/size. This needs a stat() per file, but
+        no directory listings or json parsing.
+
+        Returns True if entries were loaded.
+        """
+        manifest = self._load_state('manifest.json')
+        if not manifest or manifest.get('format') != MANIFEST_FORMAT:
+            self.log(2, 'No usable manifest')
+            return False
+
+        for dirname, mtime in manifest['dirs'].items():
+            try:
+                st = os.stat(os.path.join(self.data_dir, dirname))
+            except OSError as e:
+                self.log(2, 'Manifest out of date: %s' % (e, ))
+                return False
+            if st.st_mtime != mtime:
+                self.log(2, 'Manifest out of date: dir %r changed' % dirname)
+                return False
+
+        entries = dict()
+        for key, rec in manifest['entries'].items():
+            filename, version, content_len, content_md5, txt_stat, json_stat = rec
+            filename = filename.encode('utf-8')
+            for fullname, want in [(filename + '.txt', txt_stat),
+                                   (filename + '.json', json_stat)]:
+                try:
+                    st = os.stat(os.path.join(self.data_dir, fullname))
+                except OSError as e:
+                    self.log(2, 'Manifest out of date: %s' % (e, ))
+                    return False
+                if [st.st_mtime, st.st_size] != want:
+                    self.log(2, 'Manifest out of date: file %r changed' % fullname)
+                    return False
+            entries[key] = NoteRecord(key, version, filename,
+                                      content_len, content_md5,
+                                      tuple(txt_stat), tuple(json_stat))
+
+        self.entries = entries
+        self.updated = dict()
+        self._extra_files = set()
+        self.log(2, 'Read %d entries from manifest' % len(entries))
+        return True
+
+    def _write_manifest(self):
+        """Record current entries and file stats for _read_manifest"""
+        dirs = set([''])
+        entries = dict()
+        for key, entry in self.entries.items():
+            if entry.txt_stat is None:
+                st = os.stat(os.path.join(self.data_dir, entry.filename + '.txt'))
+                entry.txt_stat = (st.st_mtime, st.st_size)
+            if entry.json_stat is None:
+                st = os.stat(os.path.join(self.data_dir, entry.filename + '.json'))
+                entry.json_stat = (st.st_mtime, st.st_size)
+            dirname = os.path.dirname(entry.filename)
+            while dirname and dirname not in dirs:
+                dirs.add(dirname)
+                dirname = os.path.dirname(dirname)
+            entries[key] = [entry.filename, entry.version,
+                            entry.content_len, entry.content_md5,
+                            list(entry.txt_stat), list(entry.json_stat)]
+
+        dir_mtimes = dict()
+        for dirname in dirs:
+            dir_mtimes[dirname] = os.stat(
+                os.path.join(self.data_dir, dirname)).st_mtime
+
+        self._save_state('manifest.json', dict(format=MANIFEST_FORMAT,
+                                               dirs=dir_mtimes,
+                                               entries=entries))
+        self.log(2, 'Wrote manifest with %d entries' % len(entries))
+
     def _read_existing_files(self):
         self.log(2, 'Reading existing data from %r' % self.data_dir)
 
         self.entries = dict()
         self.updated = dict()
 
-        self.all_files = set()
+        # all the files found; those of entries are removed at the end
+        all_files = set()
 
-        # expected size of txt file.
-        # maps .txt filename to size
-        txt_sizes = dict()
+        # stats of .txt files with matching .json.
+        # maps .txt filename to (mtime, size)
+        txt_stats = dict()
 
         for dirpath, dirnames, filenames in os.walk(self.data_dir):
             if dirpath == self.data_dir:
-                try:
-                    dirnames.remove('.git')
-                except ValueError:
-                    pass
+                for skip in ['.git', STATE_DIR_NAME]:
+                    try:
+                        dirnames.remove(skip)
+                    except ValueError:
+                        pass
 
             if len(filenames + dirnames) == 0:
                 self.log(2, 'Directory is empty: %r' % dirpath)
@@ -243,184 +824,718 @@ class SimplenoteDownloader(object):
                 assert abs_fn.startswith(self.data_dir)
                 fullname = abs_fn[len(self.data_dir):].strip('/')
 
-                self.all_files.add(fullname)
+                all_files.add(fullname)
 
                 if fullname.endswith('.json'):
                     with open(abs_fn, 'r') as f:
                         rec = json.load(f)
-                    rec['filename__'] = fullname.rsplit('.', 1)[0]
-                    self.entries[rec['key']] = rec
+                        st = os.fstat(f.fileno())
+                    # after an interrupted sync, old files of a renamed
+                    # note may still be there. The newer one wins, the
+                    # other is deleted as an orphan.
+                    old = self.entries.get(rec['key'])
+                    if old is None or old.version < rec.get('version'):
+                        self.entries[rec['key']] = NoteRecord(
+                            rec['key'], rec.get('version'),
+                            fullname.rsplit('.', 1)[0],
+                            rec['content_len__'], rec['content_md5__'],
+                            json_stat=(st.st_mtime, st.st_size))
                 elif fullname.endswith('.txt') and \
                         os.path.exists(abs_fn.rsplit('.', 1)[0] + '.json'):
                     # .txt with matching .json. save.
-                    txt_sizes[fullname] = os.path.getsize(abs_fn)
+                    st = os.stat(abs_fn)
+                    txt_stats[fullname] = (st.st_mtime, st.st_size)
                 else:
                     self.log(1, 'Strange file found: %r' % abs_fn)
                     self.changes.append(('dejunk', fullname))
+                    self._n_damaged += 1
 
         # verify each .json has a matching .txt of proper size
         for _, val in sorted(self.entries.items()):
-            expected = val['content_len__']
-            found = txt_sizes.get(val['filename__'] + '.txt', -1)
+            all_files.discard(val.filename + '.txt')
+            all_files.discard(val.filename + '.json')
+            val.txt_stat = txt_stats.get(val.filename + '.txt')
+            expected = val.content_len
+            found = val.txt_stat[1] if val.txt_stat is not None else -1
             if expected != found:
                 self.log(0, 'Data file damaged: %r has size %d, want %d' % (
-                        val['filename__'] + '.txt', found, expected))
+                        val.filename + '.txt', found, expected))
                 # break stuff to force re-sync
-                del val['content_len__']
-                del val['version']
+                val.content_len = None
+                val.version = None
+                self._n_damaged += 1
+        self._extra_files = all_files
 
-    def sync(self):
-        # We could do a fancy sync here, passing in 'since' parameter, but it does not seem like 
-        # it is worth it, given total download only takes a few seconds.
-        all_entries = []
-        mark = None
+    def _verify(self, check_all):
+        """Check contents of notes against recorded md5.
+
+        For files storage, .txt files are hashed by a process pool. Files
+        found good are recorded in state file verify.json with their
+        mtime/size, and are skipped next time unless check_all is set.
+        """
+        if self._db is not None:
+            # all in one file, no way to tell what changed
+            self._verify_db()
+            return
+
+        good = dict() if check_all else self._load_state('verify.json', dict())
+        new_good = dict()
+        # .txt filename -> entry
+        todo = dict()
+        for entry in self.entries.values():
+            if entry.content_len is None:
+                # damaged already, will be downloaded again
+                continue
+            fullname = entry.filename + '.txt'
+            if entry.txt_stat is None:
+                st = os.stat(os.path.join(self.data_dir, fullname))
+                entry.txt_stat = (st.st_mtime, st.st_size)
+            rec = list(entry.txt_stat) + [entry.content_md5]
+            # json has unicode names
+            if good.get(_utf8(fullname).decode('utf-8')) == rec:
+                new_good[fullname] = rec
+            else:
+                todo[fullname] = entry
+
+        n_skipped = len(new_good)
+        names = sorted(todo)
+        pool = None
+        if not names:
+            results = []
+        elif multiprocessing.current_process().daemon:
+            # in --accounts pool worker, which cannot have children
+            results = itertools.imap(_md5_file, [
+                    os.path.join(self.data_dir, fn) for fn in names])
+        else:
+            n_procs = self._option('verify-jobs', multiprocessing.cpu_count(),
+                                   'getint')
+            pool = multiprocessing.Pool(n_procs)
+            results = pool.imap(_md5_file, [
+                    os.path.join(self.data_dir, fn) for fn in names], 16)
+        n_damaged = 0
+        try:
+            for fullname, md5 in itertools.izip(names, results):
+                entry = todo[fullname]
+                if md5 == entry.content_md5:
+                    new_good[fullname] = list(entry.txt_stat) + [md5]
+                    continue
+                self.log(0, 'Data file damaged: %r has md5 %s, want %s' % (
+                        fullname, md5, entry.content_md5))
+                # break stuff to force re-sync
+                entry.content_len = None
+                entry.version = None
+                self._n_damaged += 1
+                n_damaged += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
+        self.metrics.count('files_verified', len(names))
+        self._save_state('verify.json', new_good)
+        self.log(1 if n_damaged else 2,
+                 'Verified %d files (%d unchanged since last check), '
+                 '%d damaged' % (len(names) + n_skipped, n_skipped, n_damaged))
+
+    def _incremental_cursor(self):
+        """Return saved change cursor if it can be used for this run, or None"""
+        if not self.incremental:
+            return None
+        saved = self._load_state('cursor.json')
+        if not saved:
+            self.log(2, 'No saved change cursor, doing full sync')
+            return None
+        age = time.time() - saved['full_sync_time']
+        max_age = self._option('full-sync-hours', FULL_SYNC_HOURS, 'getfloat') * 3600
+        if not (0 <= age < max_age):
+            self.log(2, 'Last full sync was %.1f hours ago, doing full sync' % (age / 3600.0))
+            return None
+        if self._n_damaged:
+            self.log(1, 'Data dir had %d problems, doing full sync' % self._n_damaged)
+            return None
+        return saved['current']
+
+    def _retry(self, func, *args, **kwargs):
+        """Call func, retrying on network errors and server failures.
+
+        Errors which will not go away by themselves (4xx replies) are
+        raised at once.
+        """
+        retries = self._option('request-retries', REQUEST_RETRIES, 'getint')
+        delay = REQUEST_RETRY_DELAY
+        for attempt in itertools.count(1):
+            try:
+                return func(*args, **kwargs)
+            except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+                if attempt > retries:
+                    raise
+                if (isinstance(e, urllib2.HTTPError) and
+                    e.code < 500 and e.code != 429):
+                    raise
+                self.log(1, 'Request failed, retry %d of %d in %d sec: %s' % (
+                        attempt, retries, delay, e))
+                self.metrics.count('retries')
+                time.sleep(delay)
+                delay *= 2
+
+    def _index_pages(self, since=None, mark=None):
+        """Download index with data, starting at mark.
+
+        Yields (current cursor, mark of the next page, entries) per page.
+        """
+        sizer = self._make_page_sizer()
         while True:
-            ret = self._api_bucket.index(data=True, mark=mark)
+            limit = sizer.limit if sizer is not None else None
+            start = time.time()
+            with self.metrics.phase('index_page'):
+                ret = self._retry(self._api_bucket.index,
+                                  data=True, mark=mark, since=since,
+                                  limit=limit)
+            self.metrics.count('notes_downloaded', len(ret['index']))
             mark = ret.get('mark')
             self.log(2, 'Got data, %d items, current %r, mark %r' % (len(ret['index']), ret['current'], mark))
-            all_entries += ret['index']
+            if sizer is not None and mark is not None:
+                # the last page is short, and tells nothing about the limit
+                sizer.update(time.time() - start,
+                             sum(len(item.get('d', {}).get('content', ''))
+                                 for item in ret['index']))
+                if sizer.limit != limit:
+                    self.log(2, 'Index page size is now %d' % sizer.limit)
+            yield ret['current'], mark, ret['index']
             if mark is None:
                 break
 
-        dead = set(self.entries.keys())
-        n_deleted = n_same = n_new = n_diff = 0
-
-        for entry_raw in all_entries:
-            #import pprint; pprint.pprint(entry)
-            # merge envelope and contents into one dict
-            entry = dict(version=entry_raw['v'], key=entry_raw['id'], **entry_raw['d'])
+    def _make_page_sizer(self):
+        """PageSizer for index-page-size option, or None to let the server
+        pick the page size"""
+        size = self._option('index-page-size')
+        if size is None:
+            return None
+        if size == 'auto':
+            return PageSizer(
+                self._option('index-page-min', INDEX_PAGE_MIN, 'getint'),
+                self._option('index-page-max', INDEX_PAGE_MAX, 'getint'),
+                self._option('index-page-time', INDEX_PAGE_TIME, 'getfloat'),
+                self._option('index-page-bytes', INDEX_PAGE_BYTES, 'getint'))
+        if not size.isdigit() or int(size) == 0:
+            raise Exception('Bad index-page-size %r, want a number or auto' % (
+                    size, ))
+        return PageSizer(int(size), int(size), INDEX_PAGE_TIME, INDEX_PAGE_BYTES)
+
+    def _open_index(self):
+        """Start index download.
+
+        Picks the way to download changes. Returns (mode, pages, dead):
+          mode - 'full', 'incremental' (since saved cursor) or 'fetch'
+                 (only changed notes, found from the metadata index)
+          pages - yields (mark, list of raw index entries). For 'full'
+                 mode, this is every note; for others, changed notes only.
+                 mark is where the index download can continue after this
+                 page, or None.
+          dead - set of keys which are known to be gone. For 'full' mode,
+                 keys not seen in pages are gone as well.
+        self._new_cursor is set once the first page arrives.
+        """
+        self._new_cursor = None
+        self._trash = self._load_state('trash.json', dict())
+
+        # With 'incremental' option, ask only for changes since the last
+        # successful run. Otherwise (or if server does not like our cursor)
+        # download everything.
+        since = self._incremental_cursor()
+        resumed = self._resume_index(since)
+        if resumed is not None:
+            return resumed
+        if since is not None:
+            pages = self._index_pages(since=since)
+            try:
+                first = next(pages)
+                self.log(2, 'Incremental sync since %r' % (since, ))
+                return ('incremental',
+                        self._cursor_pages(itertools.chain([first], pages), since),
+                        set())
+            except urllib2.HTTPError as err:
+                self.log(0, 'Change cursor %r rejected, doing full sync: %s' % (since, err))
 
-            self.log(4, 'procesing entry %r' % (entry['key'], ))
+        # If we have data already, most notes are likely the same. Get
+        # versions only, and fetch changed notes individually.
+        threshold = self._option('fetch-threshold', FETCH_THRESHOLD, 'getint')
+        if threshold > 0 and self.entries:
+            ret = self._open_changed_notes(threshold)
+            if ret is not None:
+                return ('fetch', ) + ret
 
-            if entry['deleted']:
-                n_deleted += 1
-                self.log(4, 'entry was deleted')
-                if self.ignore_deleted:
-                    continue
+        self._trash = dict()
+        return 'full', self._cursor_pages(self._index_pages(), None), set(self.entries.keys())
 
-            dead.discard(entry['key'])
+    def _open_changed_notes(self, threshold):
+        """Download index without data, find changed notes.
 
-            old = self.entries.get(entry['key'], {})
-            # compare with old
-            same = True
-            for k in set(old.keys() + entry.keys()):
-                if k.endswith('__') or k == 'content':
-                    # this is out special field
-                    continue
-                if old.get(k) != entry.get(k):
-                    same = False
-                    self.log(4, 'diff in field %r: old %r, new %r' %(k, old.get(k), entry.get(k)))
-                    break
-            # skip record if it has not changed.
-            if same:
-                n_same += 1
-                continue
+        Returns (pages, dead) for _open_index, or None if more than
+        threshold notes have changed and full index is the better option.
+        """
+        versions = dict()
+        current = None
+        mark = None
+        while True:
+            with self.metrics.phase('index_page'):
+                ret = self._retry(self._api_bucket.index, mark=mark)
+            mark = ret.get('mark')
+            self.log(2, 'Got versions, %d items, current %r, mark %r' % (len(ret['index']), ret['current'], mark))
+            if current is None:
+                current = ret['current']
+            for item in ret['index']:
+                versions[item['id']] = item['v']
+            if mark is None:
+                break
 
-            if old:
-                n_diff += 1
+        changed = []
+        for key, version in versions.items():
+            if key in self.entries:
+                old_version = self.entries[key].version
             else:
-                n_new += 1
+                # we do not keep notes in trash, but remember their versions
+                old_version = self._trash.get(key)
+            if old_version != version:
+                changed.append(key)
+
+        if len(changed) > threshold:
+            self.log(2, '%d of %d notes changed, downloading full index' % (
+                    len(changed), len(versions)))
+            return None
+        self.log(2, '%d of %d notes changed, fetching them' % (
+                len(changed), len(versions)))
+
+        # we have seen all the notes, so this counts as a full sync
+        self._new_cursor = dict(current=current, full_sync_time=time.time())
+        for key in set(self._trash) - set(versions):
+            del self._trash[key]
+        dead = set(self.entries) - set(versions)
+        return self._fetch_notes(sorted(changed), versions), dead
+
+    def _resume_index(self, since):
+        """Continue index download of an interrupted run.
+
+        Returns the result for _open_index, or None if there is no
+        checkpoint, or it cannot be used.
+        """
+        checkpoint = self._load_state('checkpoint.json')
+        if not checkpoint:
+            return None
+        mode = checkpoint['mode']
+        if mode == 'full':
+            since = None
+        elif since is None:
+            self.log(2, 'Cannot continue interrupted %s sync, doing full sync' % mode)
+            return None
+        pages = self._index_pages(since=since, mark=checkpoint['mark'])
+        try:
+            first = next(pages)
+        except urllib2.HTTPError as err:
+            if err.code >= 500 or err.code == 429:
+                raise
+            self.log(0, 'Index position %r rejected, starting over: %s' % (
+                    checkpoint['mark'], err))
+            return None
+        self.log(1, 'Continuing interrupted %s sync' % mode)
+        self._new_cursor = checkpoint['cursor']
+        self._trash = checkpoint['trash']
+        # notes added by the interrupted run are not in the list, and
+        # are not gone either
+        dead = set(checkpoint['unseen']) & set(self.entries)
+        return (mode,
+                self._cursor_pages(itertools.chain([first], pages), since),
+                dead)
+
+    def _save_checkpoint(self, mode, mark, dead):
+        """Make the changes written so far durable, and record where the
+        index download can continue from"""
+        with self.metrics.phase('flush'):
+            self._flush_writes()
+        self._save_state('checkpoint.json', dict(
+                mode=mode, mark=mark, cursor=self._new_cursor,
+                unseen=sorted(dead), trash=self._trash))
+        self.log(2, 'Saved checkpoint at mark %r' % (mark, ))
+
+    def _fetch_notes(self, keys, versions):
+        """Fetch given versions of notes in parallel, yield pages of raw
+        entries (with mark None, for _open_index)"""
+        n_threads = self._option('fetch-threads', FETCH_THREADS, 'getint')
+        pool = multiprocessing.pool.ThreadPool(n_threads)
+
+        def fetch(key):
+            with self.metrics.phase('fetch_note'):
+                data = self._retry(self._api_bucket.get, key,
+                                   version=versions[key])
+            if data is not None:
+                self.metrics.count('notes_downloaded')
+            return key, data
 
-            self.log(3, 'Fetching content for entry %r' %
-                     str(entry['key']))
+        try:
+            page = []
+            for key, data in pool.imap(fetch, keys):
+                if data is None:
+                    self.log(1, 'Note %r vanished while fetching' % (key, ))
+                    continue
+                page.append(dict(id=key, v=versions[key], d=data))
+                if len(page) >= FETCH_PAGE_SIZE:
+                    yield None, page
+                    page = []
+            yield None, page
+        finally:
+            pool.terminate()
+
+    def _cursor_pages(self, pages, since):
+        for current, mark, page in pages:
+            # use cursor from the first page: anything which changes during
+            # the download will be seen again next time.
+            if self._new_cursor is None:
+                if since is None:
+                    full_sync_time = time.time()
+                else:
+                    full_sync_time = self._load_state('cursor.json')['full_sync_time']
+                self._new_cursor = dict(current=current,
+                                        full_sync_time=full_sync_time)
+            yield mark, page
 
-            # If we wanted to save bandwidth and be more effective, we could ask for data=False above,
-            # and fetch the full note here. On my account (347 notes), this reduces time from 1.8 to 1.0 sec,
-            # -- so not worth it at all.
+    def _diff_pages(self, pages, mode, dead):
+        """Compare downloaded entries with self.entries.
 
-            # copy some fields from old data, use new ones for this
-            for f in ['filename__', 'content_md5__', 'content_len__']:
-                if f in old:
-                    entry[f] = old[f]
-            self.updated[entry['key']] = entry
+        Takes the results of _open_index(). Yields (mark, list of changed
+        entries sorted by key), one per page, and then (None, list of
+        entries which are gone). dead is updated as pages are processed.
+        """
+        n_deleted = n_same = n_new = n_diff = 0
 
+        for mark, page in pages:
+            page_start = time.time()
+            changed = []
+            for entry_raw in page:
+                key, version, data = entry_raw['id'], entry_raw['v'], entry_raw['d']
+
+                self.log(4, 'procesing entry %r' % (key, ))
+
+                if data['deleted']:
+                    n_deleted += 1
+                    self.log(4, 'entry was deleted')
+                    if self.ignore_deleted:
+                        self._trash[key] = version
+                        if mode != 'full' and key in self.entries:
+                            # moved to trash since last time
+                            dead.add(key)
+                        continue
+                self._trash.pop(key, None)
+
+                # in other modes, we only see changed entries, so absent
+                # entries are not dead
+                if mode == 'full':
+                    dead.discard(key)
+
+                old = self.entries.get(key)
+                # compare with old. We do not keep metadata, but server
+                # bumps version on every change anyway.
+                if old is not None and old.version == version:
+                    # skip record if it has not changed.
+                    n_same += 1
+                    continue
+
+                if old is not None:
+                    self.log(4, 'diff in version: old %r, new %r' % (
+                            old.version, version))
+                    n_diff += 1
+                else:
+                    n_new += 1
+
+                self.log(3, 'Fetching content for entry %r' % str(key))
+
+                # merge envelope and contents into one dict
+                entry = dict(version=version, key=key, **data)
+                # copy some fields from old data, use new ones for this
+                if old is not None:
+                    entry['filename__'] = old.filename
+                    if old.content_len is not None:
+                        entry.update(content_len__=old.content_len,
+                                     content_md5__=old.content_md5)
+                changed.append(entry)
+            changed.sort(key=lambda e: e['key'])
+            self.metrics.add_time('diff', time.time() - page_start)
+            yield mark, changed
+
+        gone = []
         for key in sorted(dead):
             old = self.entries[key]
-            self.log(1, 'Note %r gone (was %r)' % (
-                    key, old.get('filename__')))
-            old['gone__'] = True
-            self.updated[key] = old
+            self.log(1, 'Note %r gone (was %r)' % (key, old.filename))
+            gone.append(dict(key=key, filename__=old.filename, gone__=True))
+        yield None, gone
 
+        self.metrics.count('notes_added', n_new)
+        self.metrics.count('notes_modified', n_diff)
+        self.metrics.count('notes_gone', len(dead))
         self.log(1 if (n_diff or n_new or dead) else 2,
-                 ('Sync done - %d same, %d in trash, %d changed, '
+                 ('Sync done%s - %d same, %d in trash, %d changed, '
                   '%d added, %d gone') % (
-                n_same, n_deleted, n_diff, n_new, len(dead)))
+                '' if mode == 'full' else ' (%s)' % mode, n_same, n_deleted, n_diff, n_new, len(dead)))
 
-    def write_files(self, pretend=False):
-        # generated filenames (no extensions), to prevent duplicates
-        # by default, seed with all unchanged filenames.
-        gen_filenames = set()
-        for entry in self.entries.values():
-            if entry['key'] in self.updated or entry.get('gone__'):
-                continue
-            gen_filenames.add(entry['filename__'])
+    def sync(self):
+        """Download changes, and store them in self.updated.
+
+        Call write_files() to save them. See sync_and_write() for a version
+        which does not keep all the changes in memory.
+        """
+        mode, pages, dead = self._open_index()
+        for _, changed in self._diff_pages(pages, mode, dead):
+            for entry in changed:
+                self.updated[entry['key']] = entry
 
+    def write_files(self, pretend=False):
+        """Write out entries collected by sync()"""
+        self._write_begin(pretend=pretend)
         # write in order sorted by key.
         for key, entry in sorted(self.updated.items()):
-            if entry.get('gone__'):
-                # entry deleted
-                del self.entries[key]
-                self.changes.append(('del', entry['filename__']))
-                continue
+            self._write_entry(entry, pretend=pretend)
+            del self.updated[key]
+        self._write_finish(pretend=pretend)
 
-            #
-            # generate path from some tags
-            #
-            path_tags = [sanitize_fname(t.lstrip('/'))
-                         for t in entry['tags']
-                         if t.startswith('/')]
-            # we should normally only have one path-tag. If not,
-            # we put longest first.
-            path_tags.sort(key=lambda x:(len(x), x))
-            # if it is pinned, we add it to the path, too
-            if 'pinned' in entry['systemTags']:
-                path_tags.append('pinned')
-            if entry['deleted']:
-                path_tags.insert(0, 'deleted')
-            # get note title from the first line of text (sanitized)
-            content_str = unicode(entry['content']).encode('utf-8')
-            basename = sanitize_fname(
-                content_str.strip().split('\n', 1)[0])
-            path_tags.append(basename)
-
-            # make the name. add characters from key if not unique
-            suffix = ''
-            seq = 0
-            while True:
-                fullname = os.path.join(*path_tags) + suffix
-                if fullname not in gen_filenames:
-                    break
-                seq += 1
-                if seq < len(key):
-                    suffix = '-' + key[:seq]
-                else:
-                    suffix = '-%s-%d' % (key, seq-len(key))
+    def sync_and_write(self, pretend=False):
+        """Download changes and write them out as each page arrives.
+
+        Only about two index pages are held in memory at once, and the next
+        page is downloaded while the current one is being written.
+
+        Every CHECKPOINT_INTERVAL seconds, and if the download fails, the
+        written notes are flushed and the index position is saved, so the
+        next run can continue from there.
+        """
+        self._write_begin(pretend=pretend)
+        mode, pages, dead = self._open_index()
+        # mark after the last page which is completely written
+        mark = None
+        checkpoint_time = time.time()
+        try:
+            for page_mark, changed in self._diff_pages(_prefetch(pages), mode, dead):
+                for entry in changed:
+                    self._write_entry(entry, pretend=pretend)
+                self._wait_writes()
+                mark = page_mark
+                if (mark is not None and not pretend and
+                    time.time() - checkpoint_time >= CHECKPOINT_INTERVAL):
+                    self._save_checkpoint(mode, mark, dead)
+                    checkpoint_time = time.time()
+        except:
+            exc_info = sys.exc_info()
+            if mark is not None and not pretend:
+                self._save_checkpoint(mode, mark, dead)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._write_finish(pretend=pretend)
+
+    def _write_begin(self, pretend):
+        # Until the changes are committed, git index does not match files,
+        # so the fast commit path is not safe.
+        self._git_state = self._load_state('git.json')
+        if not pretend:
+            self._remove_state('git.json')
+
+        if self._db is None:
+            self._writer = AtomicWriter(
+                self.data_dir, fsync=self._option('fsync', True, 'getboolean'),
+                syncfs=self._option('syncfs', False, 'getboolean'))
+            if self._write_pool is not None:
+                # left over from a failed run in daemon mode
+                self._write_pool.terminate()
+            n_threads = self._option('write-threads', WRITE_THREADS, 'getint')
+            self._write_pool = multiprocessing.pool.ThreadPool(n_threads)
+            self._write_jobs.clear()
+            self._max_write_jobs = 4 * n_threads
+
+        # generated filenames (no extensions), to prevent duplicates.
+        # Seed with all existing filenames, so names are only freed once
+        # the owner is renamed or deleted.
+        self._gen_filenames = set(entry.filename
+                                  for entry in self.entries.values())
+        self._vacated_names = set()
+        self._vacated_dirs = set()
+
+        if self._search is not None and not pretend:
+            self._update_search_index()
+
+        if self._journal is not None and not pretend:
+            self._journal_records = []
+            if self._load_state('journal-pending.json') is not None:
+                self.log(1, 'Last run was interrupted, asking journal '
+                         'readers to rescan')
+                self._journal_records.append(
+                    ('rescan', None, None, None, None, None))
+            # removed once all changes of this run are in the journal
+            self._save_state('journal-pending.json', dict(time=time.time()))
+
+    def _update_search_index(self):
+        """Index the notes which changed while the index was not updated
+        (the first run with it, runs without it, or a crash before its
+        commit). Later, changes are indexed as they are written."""
+        indexed = self._search.versions()
+        stale = set(key for key, entry in self.entries.items()
+                    if entry.version is not None and
+                    indexed.get(key) != entry.version)
+        gone = set(indexed) - set(self.entries)
+        if not stale and not gone:
+            return
+        self.log(1, 'Updating search index: %d notes changed, %d gone' % (
+                len(stale), len(gone)))
+        for key in gone:
+            self._search.delete(key)
+        if stale:
+            for meta, content in self._iter_stored_notes(stale):
+                self._search.put(meta, content)
+        self._search.commit()
+
+    def _iter_stored_notes(self, keys=None):
+        """Yield (metadata with filename__, content) of all stored notes, or
+        of those with given keys"""
+        if self._db is not None:
+            for filename, meta, content in self._db.iter_notes():
+                meta = json.loads(meta)
+                if keys is not None and meta['key'] not in keys:
+                    continue
+                meta['filename__'] = filename
+                yield meta, str(content).decode('utf-8')
+            return
+        for key, entry in sorted(self.entries.items()):
+            if keys is not None and key not in keys:
+                continue
+            fullname = os.path.join(self.data_dir, entry.filename)
+            with open(fullname + '.json', 'r') as f:
+                meta = json.load(f)
+            with open(fullname + '.txt', 'r') as f:
+                content = f.read().decode('utf-8')
+            meta['filename__'] = entry.filename
+            yield meta, content
+
+    def _write_entry(self, entry, pretend):
+        """Write one changed or gone entry, update accounting"""
+        gen_filenames = self._gen_filenames
+        key = entry['key']
+        old = self.entries.get(key)
+        if old is not None:
+            gen_filenames.discard(old.filename)
+            self._vacated_names.add(old.filename)
+
+        if entry.get('gone__'):
+            # entry deleted. Files will be removed as orphans.
+            del self.entries[key]
+            if self._db is not None:
+                if not pretend:
+                    self._db.delete(key)
+                self.changed_files.add(SQLITE_NAME)
+            if self._search is not None and not pretend:
+                self._search.delete(key)
+            self.changes.append(('del', entry['filename__']))
+            if self._journal is not None and not pretend:
+                self._journal_records.append(
+                    ('del', key, None, None, entry['filename__'], None))
+            return
 
-            # write
-            entry['filename__'] = fullname
-            self._write_one_entry(entry, pretend=pretend)
+        #
+        # generate path from some tags
+        #
+        path_tags = [sanitize_fname(t.lstrip('/'))
+                     for t in entry['tags']
+                     if t.startswith('/')]
+        # we should normally only have one path-tag. If not,
+        # we put longest first.
+        path_tags.sort(key=lambda x:(len(x), x))
+        # if it is pinned, we add it to the path, too
+        if 'pinned' in entry['systemTags']:
+            path_tags.append('pinned')
+        if entry['deleted']:
+            path_tags.insert(0, 'deleted')
+        # get note title from the first line of text (sanitized)
+        content_str = unicode(entry['content']).encode('utf-8')
+        basename = sanitize_fname(
+            content_str.strip().split('\n', 1)[0])
+        path_tags.append(basename)
 
-            if key not in self.entries:
-                self.changes.append(('add', entry['filename__']))
+        # make the name. add characters from key if not unique
+        suffix = ''
+        seq = 0
+        while True:
+            fullname = os.path.join(*path_tags) + suffix
+            if fullname not in gen_filenames:
+                break
+            seq += 1
+            if seq < len(key):
+                suffix = '-' + key[:seq]
             else:
-                self.changes.append(('mod', entry['filename__']))
+                suffix = '-%s-%d' % (key, seq-len(key))
 
-            # update accounting
-            self.entries[key] = self.updated.pop(key)
+        # write
+        entry['filename__'] = fullname
+        with self.metrics.phase('write_entry'):
+            moved = self._write_one_entry(entry, pretend=pretend)
 
-            gen_filenames.add(fullname)
+        if old is None:
+            self.changes.append(('add', entry['filename__']))
+        elif moved:
+            self.changes.append(('mv', entry['filename__'], old.filename))
+        else:
+            self.changes.append(('mod', entry['filename__']))
+
+        if self._journal is not None and not pretend:
+            renamed = old is not None and old.filename != fullname
+            self._journal_records.append(
+                (self.changes[-1][0], key, entry['version'],
+                 entry['content_md5__'], fullname,
+                 old.filename if renamed else None))
+
+        if self._search is not None and not pretend:
+            self._search.put(entry, entry['content'])
+
+        if self._history is not None and not pretend:
+            # we have this version already, no need to download it again
+            self._history.put(key, entry['version'], dict(
+                    (k, v) for k, v in entry.items()
+                    if not k.endswith('__') and k not in ('key', 'version')))
+
+        # update accounting. Content and metadata are on disk now, do not
+        # keep them.
+        # rename keeps mtime and size of .txt; other files are re-read when
+        # writing the manifest
+        self.entries[key] = NoteRecord(key, entry['version'], fullname,
+                                       entry['content_len__'],
+                                       entry['content_md5__'],
+                                       txt_stat=old.txt_stat if moved else None)
+
+        gen_filenames.add(fullname)
+
+    def _write_finish(self, pretend):
+        """Remove orphaned files, save state"""
+        if not pretend:
+            self._append_journal()
+        with self.metrics.phase('flush'):
+            if self._db is not None:
+                if not pretend:
+                    self._db.commit()
+            else:
+                self._wait_writes()
+                self._write_pool.terminate()
+                self._write_pool = None
+                self._writer.flush()
 
         # List of 'orphaned' filenames which must be deleted
-        orphaned = set(self.all_files)
-        for fn in gen_filenames:
+        orphaned = set(self._extra_files)
+        for fn in self._vacated_names - self._gen_filenames:
+            for name in [fn + '.txt', fn + '.json']:
+                # moved notes have taken their files along
+                if os.path.lexists(os.path.join(self.data_dir, name)):
+                    orphaned.add(name)
+        for fn in self._gen_filenames:
             orphaned.discard(fn + '.txt')
             orphaned.discard(fn + '.json')
 
-        maybe_empty_dirs = set()
+        maybe_empty_dirs = set(self._vacated_dirs)
         for fn in sorted(orphaned):
             self.log(1, 'Deleting file: %r' % fn)
             if not pretend:
                 os.remove(os.path.join(self.data_dir, fn))
+                self.metrics.count('files_deleted')
+            self.changed_files.add(fn)
             maybe_empty_dirs.add(os.path.dirname(fn))
 
         for fn in sorted(maybe_empty_dirs, key=lambda x: (-x.count('/'), x)):
@@ -439,6 +1554,112 @@ class SimplenoteDownloader(object):
 
         if pretend:
             self.log(1, 'Disregard all messages above, we were in pretend mode')
+            return
+
+        if self._db is None:
+            self._extra_files = set()
+            with self.metrics.phase('manifest'):
+                self._write_manifest()
+        if self._search is not None:
+            self._search.commit()
+        if self._trash is not None:
+            self._save_state('trash.json', self._trash)
+        if self._new_cursor is not None:
+            # all the changes up to cursor are on disk now
+            self._save_state('cursor.json', self._new_cursor)
+            self._new_cursor = None
+        # the next run starts from the beginning
+        self._remove_state('checkpoint.json')
+        if self._journal is not None:
+            self._remove_state('journal-pending.json')
+
+        if self._history is not None:
+            with self.metrics.phase('history'):
+                self._archive_history()
+
+    def _flush_writes(self):
+        """Make the notes written so far durable, before a checkpoint"""
+        self._append_journal()
+        if self._db is not None:
+            self._db.commit()
+        else:
+            self._wait_writes()
+            self._writer.flush()
+        if self._search is not None:
+            self._search.commit()
+        if self._history is not None:
+            self._history.commit()
+
+    def _append_journal(self):
+        """Write out journal records. This must be done before the
+        changes they describe are made durable."""
+        if self._journal is not None and self._journal_records:
+            with self.metrics.phase('journal'):
+                self._journal.append(self._journal_records)
+            self._journal_records = []
+
+    def _archive_history(self):
+        """Download versions of notes which are missing from history archive.
+
+        For each note, up to history-versions (default 30) latest versions
+        are kept. Versions which the server no longer has are recorded as
+        such, so they are only asked for once. If interrupted, the next run
+        continues where this one stopped.
+        """
+        depth = self._option('history-versions', HISTORY_VERSIONS, 'getint')
+        progress = self._history.progress()
+        # key -> [latest version, number of versions still to download]
+        remaining = dict()
+        jobs = []
+        for key, entry in sorted(self.entries.items()):
+            version = entry.version
+            done = progress.get(key, 0)
+            if version is None or done >= version:
+                continue
+            have = self._history.versions(key)
+            wanted = [v for v in xrange(max(done + 1, version - depth + 1),
+                                        version + 1)
+                      if v not in have]
+            remaining[key] = [version, len(wanted)]
+            jobs.extend((key, v) for v in wanted)
+
+        n_threads = self._option('fetch-threads', FETCH_THREADS, 'getint')
+        pool = multiprocessing.pool.ThreadPool(n_threads)
+
+        def fetch(job):
+            key, version = job
+            with self.metrics.phase('fetch_version'):
+                return key, version, self._retry(self._api_bucket.get, key,
+                                                 version=version)
+
+        n_notes = sum(1 for _, count in remaining.values() if count)
+        n_found = n_missing = 0
+        try:
+            for key, (version, count) in remaining.items():
+                if count == 0:
+                    self._history.set_progress(key, version)
+            for key, version, data in pool.imap_unordered(fetch, jobs):
+                # None means the server no longer has this version
+                self._history.put(key, version, data)
+                if data is None:
+                    n_missing += 1
+                else:
+                    n_found += 1
+                    self.metrics.count('versions_downloaded')
+                rec = remaining[key]
+                rec[1] -= 1
+                if rec[1] == 0:
+                    self._history.set_progress(key, rec[0])
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+            self.log(0, 'History download interrupted, will continue next '
+                     'time: %s' % (e, ))
+        finally:
+            pool.terminate()
+            self._history.commit()
+
+        self.log(1 if jobs else 2,
+                 'History: %d old versions of %d notes archived, %d no longer '
+                 'on server' % (n_found, n_notes, n_missing))
 
 
     def _write_one_entry(self, entry, pretend):
@@ -447,30 +1668,33 @@ class SimplenoteDownloader(object):
         content_len = len(content_str)
         content_md5 = hashlib.md5(content_str).hexdigest()
 
-        if not pretend:
-            fullname = os.path.join(self.data_dir,
-                                    entry['filename__'] + '.txt')
-            try:
-                os.makedirs(os.path.dirname(fullname))
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-
-        old_filename = self.entries.get(entry['key'], {}).get('filename__')
+        old = self.entries.get(entry['key'])
+        old_filename = old.filename if old is not None else None
 
         ext = []
+        # (name, data) to write
+        files = []
+        content_same = (content_len == entry.get('content_len__') and
+                        content_md5 == entry.get('content_md5__'))
+        # only the name changed (new path tag, pinned...): move the old
+        # files rather than writing them again
+        moved = (content_same and old_filename is not None and
+                 old_filename != entry['filename__'] and
+                 (self._db is not None or
+                  # not written or moved away earlier in this run
+                  old_filename + '.txt' not in self.changed_files))
+        if moved:
+            ext.append('mv')
+            if self._db is None:
+                self._move_files(old_filename, entry['filename__'], pretend)
         # Write data if needed
-        if (content_len != entry.get('content_len__') or
-            content_md5 != entry.get('content_md5__') or
-            old_filename != entry.get('filename__')):
+        elif (not content_same or old_filename != entry.get('filename__')):
             entry.update(content_len__=content_len,
                          content_md5__=content_md5)
             ext.append('txt')
-            if not pretend:
-                fullname = os.path.join(self.data_dir,
-                                        entry['filename__'] + '.txt')
-                with open(fullname, 'w') as f:
-                    f.write(content_str)
+            if self._db is None:
+                self.changed_files.add(entry['filename__'] + '.txt')
+                files.append((entry['filename__'] + '.txt', content_str))
 
         # create extra records for easier data viewing
         for f in ['creationDate', 'modificationDate']:
@@ -483,17 +1707,349 @@ class SimplenoteDownloader(object):
         entry2.pop('content')
         msg = json.dumps(entry2, sort_keys=True, indent=1)
         ext.append('json')
-        if not pretend:
-            fullname = os.path.join(self.data_dir,
-                                    entry['filename__'] + '.json')
-            with open(fullname, 'w') as f:
-                f.write(msg)    # pylint: disable=no-member
+        if self._db is not None:
+            # one row with both, json kept as text so export() gives the
+            # same files as files storage
+            self.changed_files.add(SQLITE_NAME)
+            if not pretend:
+                self._db.put(entry, msg, content_str)
+        else:
+            self.changed_files.add(entry['filename__'] + '.json')
+            files.append((entry['filename__'] + '.json', msg))
+            if not pretend:
+                self._submit_writes(files)
 
         self.log(1, 'Wrote entry %s to %r(%s)' % (
                 repr(entry['key'][:8])[1:].strip("'"),
                 str(entry['filename__']), ','.join(ext)))
+        return moved
+
+    def _submit_writes(self, files):
+        """Write (name, data) pairs in the write pool.
+
+        Only the file writes are done there. Everything else, and the
+        renames of moved notes in particular, is done in the calling
+        thread, in order.
+        """
+        self._write_jobs.append(
+            self._write_pool.apply_async(self._write_files, (files, )))
+        # see errors early, and do not queue up too much
+        while self._write_jobs and (
+            self._write_jobs[0].ready() or
+            len(self._write_jobs) > self._max_write_jobs):
+            self._write_jobs.popleft().get()
+
+    def _write_files(self, files):
+        for name, data in files:
+            self._writer.write(name, data)
+            self.metrics.count('files_written')
+
+    def _wait_writes(self):
+        """Wait until all the submitted writes are done"""
+        while self._write_jobs:
+            self._write_jobs.popleft().get()
+
+    def _move_files(self, old_name, new_name, pretend):
+        """Rename .txt and .json of a note (no extensions in names)"""
+        self._vacated_dirs.add(os.path.dirname(old_name))
+        for ext in ['.txt', '.json']:
+            self.changed_files.add(old_name + ext)
+            self.changed_files.add(new_name + ext)
+            if pretend:
+                continue
+            self._writer.rename(old_name + ext, new_name + ext)
+
+    def export(self, out_dir):
+        """Write notes from sqlite storage to out_dir as .txt/.json files,
+        laid out as files storage would have them."""
+        if self._db is None:
+            raise Exception('Nothing to export -- storage is not sqlite')
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        writer = AtomicWriter(out_dir,
+                              fsync=self._option('fsync', True, 'getboolean'),
+                              syncfs=self._option('syncfs', False, 'getboolean'))
+        n_notes = 0
+        for filename, meta, content in self._db.iter_notes():
+            writer.write(filename + '.txt', content)
+            writer.write(filename + '.json', meta)
+            n_notes += 1
+        writer.flush()
+        self.log(1, 'Exported %d notes to %r' % (n_notes, out_dir))
+
+    def _live_keys(self):
+        """Keys of notes which are on the server and not in trash.
+
+        The index is downloaded without data. A note at the version we have
+        (or saw in trash) is known to be in trash or not; only the other
+        notes are fetched to find out.
+        """
+        trash = self._load_state('trash.json', dict())
+        live = set()
+        unknown = dict()
+        mark = None
+        while True:
+            with self.metrics.phase('index_page'):
+                ret = self._retry(self._api_bucket.index, mark=mark)
+            for item in ret['index']:
+                key, version = item['id'], item['v']
+                entry = self.entries.get(key)
+                if entry is not None and entry.version == version:
+                    live.add(key)
+                elif trash.get(key) != version:
+                    unknown[key] = version
+            mark = ret.get('mark')
+            if mark is None:
+                break
+
+        self.log(2, '%d notes on server changed since last backup, '
+                 'fetching them' % (len(unknown), ))
+        for _, page in self._fetch_notes(sorted(unknown), unknown):
+            for item in page:
+                if not item['d'].get('deleted'):
+                    live.add(item['id'])
+        return live
+
+    def restore(self, rev=None, pretend=False):
+        """Upload notes from the backup (or from git revision rev of it) to
+        the account. Returns exit status.
+
+        Notes which are on the server and not in trash are left alone. Keys
+        are logged to state file restore.log as they are uploaded, so an
+        interrupted restore of the same source skips them when re-run.
+        """
+        if rev is not None:
+            if self._db is not None:
+                raise Exception('Cannot restore git revision with sqlite storage')
+            source = self._git_output(['rev-parse', '--verify',
+                                       '%s^{commit}' % rev])
+            notes = self._iter_git_notes(source)
+        else:
+            source = 'data-dir'
+            notes = self._iter_stored_notes()
+
+        done = self._restore_progress(source)
+        if done:
+            self.log(0, 'Resuming restore from %s, %d notes already done' % (
+                    source, len(done)))
+
+        live = self._live_keys()
+
+        n_threads = self._option('restore-threads', RESTORE_THREADS, 'getint')
+        pool = multiprocessing.pool.ThreadPool(n_threads)
+        delay = AdaptiveDelay(RESTORE_MAX_DELAY)
+        fields_skip = set(['key', 'version'])
+
+        def upload(job):
+            key, data = job
+            while True:
+                delay.wait()
+                try:
+                    with self.metrics.phase('upload'):
+                        self._api_bucket.replace_item(key, data)
+                except urllib2.HTTPError as e:
+                    if e.code not in (429, 503):
+                        raise
+                    delay.throttled(e.info().getheader('Retry-After'))
+                    self.metrics.count('throttled')
+                    continue
+                delay.succeeded()
+                return key
+
+        n_done = n_live = 0
+        progress = None
+        if not pretend:
+            progress = open(self._state_file('restore.log'), 'a')
+            if not done:
+                print >>progress, source
+        try:
+            for batch in _batches(notes, RESTORE_BATCH_SIZE):
+                jobs = []
+                for meta, content in batch:
+                    key = meta['key']
+                    if key in done:
+                        continue
+                    if key in live:
+                        n_live += 1
+                        self.log(2, 'Not restoring %r, on server already' % (
+                                meta['filename__'], ))
+                        continue
+                    data = dict((k, v) for k, v in meta.items()
+                                if not k.endswith('__') and k not in fields_skip)
+                    data.update(content=content, deleted=False)
+                    self.log(1, 'Restoring %r' % (meta['filename__'], ))
+                    jobs.append((key, data))
+                if pretend:
+                    n_done += len(jobs)
+                    continue
+                for key in pool.imap_unordered(upload, jobs):
+                    print >>progress, key
+                    n_done += 1
+                progress.flush()
+                self.log(2, 'Restored %d notes so far' % (n_done, ))
+        finally:
+            pool.terminate()
+            if progress is not None:
+                progress.close()
+
+        if pretend:
+            self.log(1, 'Disregard all messages above, we were in pretend mode')
+        else:
+            # finished, next restore starts from scratch
+            self._remove_state('restore.log')
+        self.log(0, 'Restored %d notes, %d left alone as they are on server' % (
+                n_done, n_live))
+        return 0
+
+    def _restore_progress(self, source):
+        """Keys uploaded by an interrupted restore from the same source"""
+        try:
+            with open(self._state_file('restore.log'), 'r') as f:
+                lines = f.read().splitlines()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return set()
+        if not lines or lines[0] != source:
+            self.log(0, 'Ignoring progress of restore from another source')
+            self._remove_state('restore.log')
+            return set()
+        return set(lines[1:])
+
+    def _iter_git_notes(self, commit):
+        """Like _iter_stored_notes, but reads notes from git commit"""
+        listing = self._git_output(['ls-tree', '-r', '-z', commit])
+        blobs = dict()
+        for line in listing.split('\0'):
+            if not line:
+                continue
+            info, path = line.split('\t', 1)
+            _, kind, sha = info.split()
+            if kind == 'blob':
+                blobs[path] = sha
+        names = sorted(path[:-len('.json')] for path in blobs
+                       if path.endswith('.json') and
+                       path[:-len('.json')] + '.txt' in blobs and
+                       not path.startswith(STATE_DIR_NAME + '/'))
+        for batch in _batches(names, RESTORE_BATCH_SIZE):
+            shas = []
+            for name in batch:
+                shas += [blobs[name + '.json'], blobs[name + '.txt']]
+            proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    cwd=self.data_dir)
+            out, _ = proc.communicate(''.join(sha + '\n' for sha in shas))
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, 'git cat-file')
+            # each is "<sha> blob <size>\n<contents>\n"
+            contents = []
+            pos = 0
+            while pos < len(out):
+                header_end = out.index('\n', pos)
+                size = int(out[pos:header_end].split()[2])
+                contents.append(out[header_end + 1:header_end + 1 + size])
+                pos = header_end + 1 + size + 1
+            for i, name in enumerate(batch):
+                meta = json.loads(contents[2 * i])
+                meta['filename__'] = name
+                yield meta, contents[2 * i + 1].decode('utf-8')
+
+    def run_daemon(self, git=False, print_changes=False):
+        """Sync forever, within seconds of changes on the server.
+
+        Waits on the server's change feed using long polls. Once changes
+        arrive, waits until there were none for daemon-debounce seconds
+        (but no more than DAEMON_MAX_DELAY), then does an incremental sync
+        and commit. All state is kept in memory between syncs.
+        """
+        debounce = self._option('daemon-debounce', DAEMON_DEBOUNCE, 'getfloat')
+        self.incremental = True
+        delay = DAEMON_RETRY_DELAY
+        while True:
+            try:
+                self._daemon_cycle(git, print_changes)
+                cursor = self._load_state('cursor.json')['current']
+                self._wait_for_changes(cursor, debounce)
+                delay = DAEMON_RETRY_DELAY
+            except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+                self.log(0, 'Network error, retrying in %d sec: %s' % (delay, e))
+                time.sleep(delay)
+                delay = min(delay * 2, DAEMON_MAX_RETRY_DELAY)
+                # in case we failed halfway through writing
+                self._read_entries()
+
+    def _daemon_cycle(self, git, print_changes):
+        success = False
+        try:
+            self.sync_and_write()
+            if git:
+                self.maybe_checkin_to_git()
+            success = True
+        finally:
+            self.write_metrics(success)
+            # next cycle starts counting from zero
+            self.metrics = self._api_bucket.metrics = Metrics()
+        if print_changes:
+            import pprint
+            pprint.pprint(self.changes)
+            sys.stdout.flush()
+        self.changes = list()
+        self.changed_files = set()
+        # files were re-written, so incremental sync is safe now
+        self._n_damaged = 0
+
+    def _wait_for_changes(self, cursor, debounce):
+        """Block until notes change after cursor, and then stay unchanged
+        for debounce seconds. Returns without changes after DAEMON_IDLE_TIME,
+        so the periodic full sync can happen.
+        """
+        start = time.time()
+        first = last = None
+        while True:
+            now = time.time()
+            if first is None:
+                timeout = start + DAEMON_IDLE_TIME - now
+            else:
+                timeout = min(last + debounce, first + DAEMON_MAX_DELAY) - now
+            if timeout <= 0:
+                return
+            poll_start = time.time()
+            try:
+                changes = self._api_bucket.changes(cv=cursor, timeout=max(timeout, 1))
+            except socket.timeout:
+                changes = []
+            except urllib2.URLError as e:
+                if not isinstance(e.reason, socket.timeout):
+                    raise
+                changes = []
+            if changes:
+                self.log(2, 'Got %d changes, latest %r' % (len(changes), changes[-1]['cv']))
+                cursor = changes[-1]['cv']
+                last = time.time()
+                if first is None:
+                    first = last
+            else:
+                # returned early with nothing: do not busy-loop
+                time.sleep(max(0, min(poll_start + DAEMON_MIN_POLL - time.time(),
+                                      timeout)))
+
+    def write_metrics(self, success):
+        """Write metrics of this run to files given in config/command line"""
+        self.metrics.finish(success)
+        labels = dict(user=self.sn_username)
+        if self.metrics_json:
+            self.metrics.write_json(self.metrics_json, labels)
+        if self.metrics_prom:
+            self.metrics.write_prometheus(self.metrics_prom, labels)
+        for line in self.metrics.summary():
+            self.log(2, line)
 
     def verify_git(self):
+        if self._db is not None:
+            raise Exception('Cannot use git with sqlite storage: every run '
+                            'would add a full copy of %s to the repo. Use '
+                            'history = yes to keep old versions' % (
+                    SQLITE_NAME, ))
         if not os.path.isdir(
             os.path.join(self.data_dir, '.git')):
             raise Exception('Data dir has no git repo. To fix:\n'
@@ -502,23 +2058,78 @@ class SimplenoteDownloader(object):
     def maybe_checkin_to_git(self, pretend=False):
         if len(self.changes) == 0:
             self.log(2, 'No changes -- not doing anything with git')
+            if self._git_state is not None and not pretend:
+                # nothing written, so git index is still in sync
+                self._save_state('git.json', self._git_state)
             return
 
         # make commit name
         if len(self.changes) > 2:
             # summary: 5x add, 2x remove
             gcount = dict()
-            for etype, _ in self.changes:
-                gcount[etype] = gcount.get(etype, 0) + 1
+            for change in self.changes:
+                gcount[change[0]] = gcount.get(change[0], 0) + 1
             message = ', '.join('%dx %s' % (count, etype)
                                 for (etype, count) in sorted(gcount.items()))
         else:
-            # Individual files.
-            message = ', '.join('%s: %s' % (etype, repr(ename)[1:].strip("'\""))
-                                for (etype, ename) in self.changes)
+            # Individual files. 'mv' has new and old names.
+            message = ', '.join(
+                '%s: %s' % (change[0], ' <- '.join(repr(ename)[1:].strip("'\"")
+                                                   for ename in change[1:]))
+                for change in self.changes)
 
         self.log(1, 'commiting with message: %s' % message)
 
+        # The fast path only looks at files we have changed, so it can only
+        # be used if the last commit was made by us, and nothing happened
+        # since.
+        head = self._git_output(['rev-parse', '--verify', '--quiet', 'HEAD'],
+                                check=False)
+        with self.metrics.phase('git'):
+            if (self._option('git-mode', 'fast') == 'fast' and head and
+                self._git_state is not None and self._git_state.get('head') == head):
+                self._git_commit_fast(message, head, pretend=pretend)
+            else:
+                self._git_commit_porcelain(message, pretend=pretend)
+
+        if not pretend:
+            head = self._git_output(['rev-parse', '--verify', 'HEAD'])
+            self._save_state('git.json', dict(head=head))
+
+    def _git_output(self, args, stdin=None, check=True):
+        """Run git command in data dir, return its stripped output"""
+        cmd = ['git'] + args
+        self.log(3 if stdin is None else 2, 'Running %r' % (cmd, ))
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, cwd=self.data_dir)
+        out, _ = proc.communicate(stdin or '')
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return out.strip()
+
+    def _git_commit_fast(self, message, head, pretend):
+        """Commit only self.changed_files, using git plumbing.
+
+        Only the changed paths are hashed into the index, and write-tree
+        reuses cached trees for unchanged directories, so the cost does not
+        depend on the size of the repo.
+        """
+        paths = sorted(self.changed_files)
+        cmd = ['update-index', '--add', '--remove', '-z', '--stdin']
+        if pretend:
+            self.log(2, 'Would run: %r on %d paths' % (cmd, len(paths)))
+            return
+        self._git_output(cmd, stdin=''.join(p + '\0' for p in paths))
+
+        tree = self._git_output(['write-tree'])
+        if tree == self._git_output(['rev-parse', 'HEAD^{tree}']):
+            self.log(1, 'No changes in git tree -- not committing')
+            return
+        commit = self._git_output(['commit-tree', tree, '-p', head, '-m', message])
+        self._git_output(['update-ref', '-m', 'commit: ' + message,
+                          'HEAD', commit, head])
+
+    def _git_commit_porcelain(self, message, pretend):
         devnull = open('/dev/null', 'r+')
         # commit
         cmd = ['git', 'add', '--all']
@@ -538,6 +2149,749 @@ class SimplenoteDownloader(object):
 
 
 
+class AuthRetryBucket(simperium.core.Bucket):
+    """Simperium bucket which gets a new token when the old one is refused.
+
+    reauth(old_token, error) is called on 401/403 replies, and the request
+    is retried once with the token it returns.
+
+    Requests do not go through urllib2: each thread keeps a connection open
+    to the server, so a sync needs one TCP/TLS handshake rather than one per
+    request, and gzip-compressed replies are accepted. Behind a proxy, this
+    falls back to urllib2.
+    """
+
+    def __init__(self, appname, auth_token, bucket, reauth, metrics, **kwargs):
+        simperium.core.Bucket.__init__(self, appname, auth_token, bucket, **kwargs)
+        self._reauth = reauth
+        self.metrics = metrics
+        # per-thread dict (scheme, host) -> httplib connection
+        self._local = threading.local()
+
+    def _request(self, url, data=None, headers=None, method=None, timeout=None):
+        token = self.auth_token
+        try:
+            return self._send(url, data, headers, method, timeout)
+        except urllib2.HTTPError as err:
+            if err.code not in (401, 403):
+                raise
+            self.auth_token = self._reauth(token, err)
+        headers = dict(headers or {})
+        headers.update(self._auth_header())
+        return self._send(url, data, headers, method, timeout)
+
+    def _send(self, url, data, headers, method, timeout):
+        """Make one request. Returns response, or raises HTTPError, like
+        urllib2.urlopen"""
+        self.metrics.count('requests')
+        url = '%s://%s/1/%s' % (self.scheme, self.host, url)
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip'
+        if method is None:
+            method = 'GET' if data is None else 'POST'
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+
+        if self.scheme in urllib.getproxies():
+            request = urllib2.Request(url, data, headers=headers)
+            request.get_method = lambda: method
+            try:
+                response = urllib2.urlopen(request, timeout=timeout)
+            except urllib2.HTTPError as err:
+                # can be read like a response
+                response = err
+            code, reason, msg = response.code, response.msg, response.info()
+            body = response.read()
+        else:
+            code, reason, msg, body = self._send_keepalive(
+                url, data, headers, method, timeout)
+
+        self.metrics.count('bytes_downloaded', len(body))
+        if msg.getheader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if code >= 400:
+            raise urllib2.HTTPError(url, code, reason, msg, StringIO.StringIO(body))
+        return urllib.addinfourl(StringIO.StringIO(body), msg, url, code)
+
+    def _send_keepalive(self, url, data, headers, method, timeout):
+        """Send request over this thread's connection to the host.
+        Returns (status, reason, headers, body)"""
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn_key = (parts.scheme, parts.netloc)
+        conns = self._local.__dict__.setdefault('conns', dict())
+        conn = conns.get(conn_key)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                if parts.scheme == 'https':
+                    conn = httplib.HTTPSConnection(parts.netloc, timeout=timeout)
+                else:
+                    conn = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+                conns[conn_key] = conn
+                self.metrics.count('connections')
+            else:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse(buffering=True)
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                del conns[conn_key]
+                conn = None
+                # server may have closed the connection while it was idle.
+                # Try again once, with a new one.
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                reused = False
+                self.metrics.count('reconnects')
+                continue
+            if response.will_close:
+                conn.close()
+                del conns[conn_key]
+            return response.status, response.reason, response.msg, body
+
+    def replace_item(self, item, data):
+        """Like post(replace=True), but raises HTTPError rather than
+        returning None, so the caller can tell rate limits from failures"""
+        url = '%s/%s/i/%s?%s' % (self.appname, self.bucket, item, urllib.urlencode(
+                dict(clientid=self.clientid, ccid=uuid.uuid4().hex, replace=1)))
+        self._request(url, json.dumps(data), headers=self._auth_header()).read()
+
+
+class Metrics(object):
+    """Timings and counters of one run.
+
+    phase() times a block of code; times are summed per phase name, so a
+    phase may run many times (and in several threads). count() increments
+    a counter. Both are thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.success = None
+        # name -> [number of calls, total seconds, max seconds]
+        self.phases = dict()
+        self.counters = dict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            rec = self.phases.setdefault(name, [0, 0.0, 0.0])
+            rec[0] += 1
+            rec[1] += seconds
+            rec[2] = max(rec[2], seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, success):
+        self.end_time = time.time()
+        self.success = success
+
+    def report(self):
+        return dict(
+            start_time=self.start_time,
+            duration=(self.end_time or time.time()) - self.start_time,
+            success=self.success,
+            phases=dict((name, dict(calls=calls, seconds=total, max_seconds=longest))
+                        for name, (calls, total, longest) in self.phases.items()),
+            counters=dict(self.counters))
+
+    def summary(self):
+        """Lines of human-readable summary"""
+        report = self.report()
+        yield 'Run took %.2f sec' % report['duration']
+        for name, rec in sorted(self.phases.items()):
+            yield '  %-15s %7.3f sec in %d calls' % (name, rec[1], rec[0])
+        for name, value in sorted(self.counters.items()):
+            yield '  %-15s %d' % (name, value)
+
+    def write_json(self, filename, labels):
+        report = self.report()
+        report.update(labels)
+        _write_file_atomic(filename, json.dumps(report, sort_keys=True, indent=1,
+                                                separators=(',', ': ')) + '\n')
+
+    def write_prometheus(self, filename, labels):
+        """Write file for node_exporter's textfile collector"""
+        report = self.report()
+        prefix = 'simplenote_backup_'
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s%s gauge' % (prefix, name))
+            for extra, value in samples:
+                all_labels = dict(labels, **extra)
+                lines.append('%s%s{%s} %r' % (
+                        prefix, name,
+                        ','.join('%s="%s"' % (k, _prom_escape(v))
+                                 for k, v in sorted(all_labels.items())),
+                        float(value)))
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run.',
+               [({}, report['start_time'])])
+        metric('run_seconds', 'Duration of the last run.',
+               [({}, report['duration'])])
+        metric('success', '1 if the last run succeeded.',
+               [({}, 1 if report['success'] else 0)])
+        phases = sorted(report['phases'].items())
+        metric('phase_seconds', 'Time spent in each phase of the last run.',
+               [(dict(phase=name), rec['seconds']) for name, rec in phases])
+        metric('phase_calls', 'Number of times each phase ran in the last run.',
+               [(dict(phase=name), rec['calls']) for name, rec in phases])
+        metric('phase_max_seconds', 'Longest single run of each phase.',
+               [(dict(phase=name), rec['max_seconds']) for name, rec in phases])
+        for name, value in sorted(report['counters'].items()):
+            metric(name, 'Counter %s of the last run.' % name, [({}, value)])
+        _write_file_atomic(filename, '\n'.join(lines) + '\n')
+
+
+def _prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_file_atomic(filename, data):
+    with open(filename + '.tmp', 'w') as f:
+        f.write(data)
+    os.rename(filename + '.tmp', filename)
+
+
+class AtomicWriter(object):
+    """Writes files so they are never seen half-written.
+
+    Each file is written to a temp file next to it. Every batch_size files,
+    or on flush(), the temp files are synced to disk and renamed into
+    place, and the renames are synced as well. With syncfs, where syncfs()
+    is available, this costs two syncs per batch rather than one per file;
+    but they sync the whole filesystem, including other programs' data.
+
+    Can be used from several threads at once, as long as they write
+    different files.
+    """
+
+    def __init__(self, base_dir, batch_size=WRITE_BATCH_SIZE, fsync=True,
+                 syncfs=False):
+        self.base_dir = base_dir
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.syncfs = syncfs and _syncfs is not None
+        # protects all of the below. Temp files are written without it.
+        self._lock = threading.Lock()
+        # directories known to exist
+        self._made_dirs = set()
+        # maps final name -> temp name, for files waiting for flush()
+        self._pending = dict()
+        # directories with renames to sync on flush()
+        self._renamed_dirs = set()
+
+    def _make_dir(self, dirname):
+        if dirname not in self._made_dirs:
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._made_dirs.add(dirname)
+
+    def write(self, relname, data):
+        fullname = os.path.join(self.base_dir, _utf8(relname))
+        dirname = os.path.dirname(fullname)
+        with self._lock:
+            if fullname in self._pending:
+                self._flush()
+            self._make_dir(dirname)
+
+        # leading dot and extension make the scanner treat leftovers
+        # from a crash as junk
+        tmpname = os.path.join(dirname,
+                               '.%s.tmp' % os.path.basename(fullname))
+        with open(tmpname, 'w') as f:
+            f.write(data)
+
+        with self._lock:
+            self._pending[fullname] = tmpname
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def rename(self, old_relname, new_relname):
+        """Move a file which is already in place. Synced by next flush()"""
+        old_fullname = os.path.join(self.base_dir, _utf8(old_relname))
+        new_fullname = os.path.join(self.base_dir, _utf8(new_relname))
+        with self._lock:
+            self._make_dir(os.path.dirname(new_fullname))
+            os.rename(old_fullname, new_fullname)
+            self._renamed_dirs.add(os.path.dirname(old_fullname))
+            self._renamed_dirs.add(os.path.dirname(new_fullname))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending and not self._renamed_dirs:
+            return
+        pending = sorted(self._pending.items())
+        dirs = set(os.path.dirname(fullname) for fullname, _ in pending)
+        dirs.update(self._renamed_dirs)
+        if self.fsync:
+            self._sync([tmpname for _, tmpname in pending])
+        for fullname, tmpname in pending:
+            os.rename(tmpname, fullname)
+        if self.fsync:
+            self._sync(sorted(dirs))
+        self._pending.clear()
+        self._renamed_dirs.clear()
+
+    def _sync(self, names):
+        """Make names (files or dirs) durable"""
+        if self.syncfs:
+            names = names[:1]
+        for name in names:
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                if self.syncfs:
+                    if _syncfs(fd) != 0:
+                        err = ctypes.get_errno()
+                        raise OSError(err, os.strerror(err))
+                else:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+# syncfs(2) syncs a whole filesystem with one call. Linux only.
+try:
+    _syncfs = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syncfs
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+class SqliteStore(object):
+    """Notes kept in a single sqlite file, one row per note.
+
+    Each row has the bookkeeping fields, the note's json metadata (exactly as
+    files storage writes it to .json) and the content. All changes of a run
+    are one transaction, made durable by commit().
+    """
+
+    def __init__(self, filename, fsync=True):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.text_factory = str
+        if not fsync:
+            self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS notes ('
+            ' key TEXT PRIMARY KEY,'
+            ' version INTEGER,'
+            ' filename TEXT NOT NULL,'
+            ' content_len INTEGER NOT NULL,'
+            ' content_md5 TEXT NOT NULL,'
+            ' meta TEXT NOT NULL,'
+            ' content BLOB NOT NULL)')
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def iter_entries(self):
+        """Yield (key, version, filename, content_len, content_md5)"""
+        return self._conn.execute(
+            'SELECT key, version, filename, content_len, content_md5 '
+            'FROM notes')
+
+    def iter_contents(self):
+        """Yield (key, content)"""
+        return self._conn.execute('SELECT key, content FROM notes')
+
+    def iter_notes(self):
+        """Yield (filename, meta, content), sorted by filename"""
+        return self._conn.execute(
+            'SELECT filename, meta, content FROM notes ORDER BY filename')
+
+    def put(self, entry, meta, content):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO notes (key, version, filename, '
+            'content_len, content_md5, meta, content) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (entry['key'], entry.get('version'), entry['filename__'],
+             entry['content_len__'], entry['content_md5__'],
+             meta, sqlite3.Binary(content)))
+
+    def delete(self, key):
+        self._conn.execute('DELETE FROM notes WHERE key = ?', (key, ))
+
+    def commit(self):
+        self._conn.commit()
+
+
+class HistoryArchive(object):
+    """Old versions of notes, in a sqlite file.
+
+    revisions has one row per (key, version), with note data as
+    zlib-compressed json, or NULL if the server did not have that version.
+    progress has, for each note, the version up to which all the wanted
+    versions were looked at.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS revisions ('
+            ' key TEXT NOT NULL,'
+            ' version INTEGER NOT NULL,'
+            ' data BLOB,'
+            ' PRIMARY KEY (key, version))')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS progress ('
+            ' key TEXT PRIMARY KEY,'
+            ' version INTEGER NOT NULL)')
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def progress(self):
+        """Returns dict key -> version"""
+        return dict(self._conn.execute('SELECT key, version FROM progress'))
+
+    def set_progress(self, key, version):
+        self._conn.execute('INSERT OR REPLACE INTO progress (key, version) '
+                           'VALUES (?, ?)', (key, version))
+
+    def versions(self, key):
+        """Returns set of versions of key we have (or know to be missing)"""
+        return set(v for v, in self._conn.execute(
+                'SELECT version FROM revisions WHERE key = ?', (key, )))
+
+    def put(self, key, version, data):
+        if data is not None:
+            data = sqlite3.Binary(zlib.compress(
+                    json.dumps(data, sort_keys=True, separators=(',', ':'))))
+        self._conn.execute('INSERT OR REPLACE INTO revisions (key, version, data) '
+                           'VALUES (?, ?, ?)', (key, version, data))
+
+    def get(self, key, version):
+        """Returns note data, or None if we do not have it"""
+        row = self._conn.execute(
+            'SELECT data FROM revisions WHERE key = ? AND version = ?',
+            (key, version)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def commit(self):
+        self._conn.commit()
+
+
+class SearchIndex(object):
+    """Full-text index of notes, in a sqlite file (needs FTS5).
+
+    Index rows are tied to note keys by the keys table, so that a note can be
+    updated or removed without a full scan. The table also has the indexed
+    version of each note, so that notes changed by runs which did not
+    update the index can be found.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, timeout=60)
+        self._conn.text_factory = str
+        try:
+            self._conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5('
+                ' filename, tags, created, modified, content)')
+        except sqlite3.OperationalError as e:
+            raise Exception('Cannot make search index, sqlite needs FTS5: %s'
+                            % (e, ))
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(keys)')]
+        if columns and 'version' not in columns:
+            # made by an older version, without note versions: start over
+            self._conn.execute('DELETE FROM notes')
+            self._conn.execute('DROP TABLE keys')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS keys ('
+            ' id INTEGER PRIMARY KEY,'
+            ' key TEXT UNIQUE NOT NULL,'
+            ' version INTEGER)')
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def versions(self):
+        """Returns dict key -> indexed version"""
+        return dict(self._conn.execute('SELECT key, version FROM keys'))
+
+    def put(self, entry, content):
+        """Add or replace note. Entry is a note record, as in .json files"""
+        row = self._conn.execute('SELECT id FROM keys WHERE key = ?',
+                                 (entry['key'], )).fetchone()
+        if row is None:
+            rowid = self._conn.execute(
+                'INSERT INTO keys (key, version) VALUES (?, ?)',
+                (entry['key'], entry['version'])).lastrowid
+        else:
+            rowid = row[0]
+            self._conn.execute('DELETE FROM notes WHERE rowid = ?', (rowid, ))
+            self._conn.execute('UPDATE keys SET version = ? WHERE id = ?',
+                               (entry['version'], rowid))
+        self._conn.execute(
+            'INSERT INTO notes (rowid, filename, tags, created, modified, '
+            'content) VALUES (?, ?, ?, ?, ?, ?)',
+            (rowid, entry['filename__'], ' '.join(entry.get('tags', [])),
+             entry.get('creationDate_str__'), entry.get('modificationDate_str__'),
+             content))
+
+    def delete(self, key):
+        row = self._conn.execute('SELECT id FROM keys WHERE key = ?',
+                                 (key, )).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM notes WHERE rowid = ?', row)
+            self._conn.execute('DELETE FROM keys WHERE id = ?', row)
+
+    def search(self, query, limit):
+        """Returns list of (filename, modified, snippet), best match first"""
+        return self._conn.execute(
+            "SELECT filename, modified, snippet(notes, 4, '[', ']', '...', 12) "
+            "FROM notes WHERE notes MATCH ? ORDER BY rank LIMIT ?",
+            (query, limit)).fetchall()
+
+    def commit(self):
+        self._conn.commit()
+
+
+class Journal(object):
+    """Append-only log of changes, one json array per line.
+
+    See the module docstring for the format. A partial last line, left by a
+    crash, is ignored by readers and dropped by the next append.
+    """
+
+    def __init__(self, filename, fsync=True):
+        self.filename = filename
+        self.fsync = fsync
+
+    def append(self, records):
+        """Append (op, key, version, md5, filename, old filename) records,
+        numbering them after the last line"""
+        with open(self.filename, 'a+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - JOURNAL_TAIL_SIZE))
+            tail = f.read()
+            partial = tail.rsplit('\n', 1)[-1]
+            if partial:
+                f.truncate(size - len(partial))
+            lines = tail[:len(tail) - len(partial)].splitlines()
+            seq = json.loads(lines[-1])[0] if lines else 0
+
+            now = int(time.time())
+            out = []
+            for rec in records:
+                seq += 1
+                out.append(json.dumps([seq, now] + list(rec),
+                                      separators=(',', ':')) + '\n')
+            f.write(''.join(out))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def read(self, after=0):
+        """Yield records (as lists, seq first) with seq > after"""
+        try:
+            f = open(self.filename, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with f:
+            f.seek(self._find(f, after))
+            for line in f:
+                if not line.endswith('\n'):
+                    # still being written
+                    break
+                rec = json.loads(line)
+                if rec[0] > after:
+                    yield rec
+
+    def _find(self, f, after):
+        """Binary search for the offset of the first line with seq > after"""
+        def line_start(pos):
+            # offset of the first line which starts at pos or later
+            f.seek(max(0, pos - 1))
+            if pos > 0:
+                f.readline()
+            return f.tell()
+
+        f.seek(0, os.SEEK_END)
+        lo, hi = 0, f.tell()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line_start(mid)
+            line = f.readline()
+            if line.endswith('\n') and json.loads(line)[0] <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        return line_start(lo)
+
+
+class AdaptiveDelay(object):
+    """Delay before each request, shared by threads, which grows when the
+    server says we are too fast, and shrinks back as requests succeed."""
+
+    def __init__(self, max_delay):
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.delay:
+            time.sleep(self.delay)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            self.delay = min(max(self.delay * 2, 0.5), self.max_delay)
+            try:
+                self.delay = min(max(self.delay, float(retry_after)),
+                                 self.max_delay)
+            except (TypeError, ValueError):
+                pass
+
+    def succeeded(self):
+        with self._lock:
+            self.delay *= 0.9
+            if self.delay < 0.01:
+                self.delay = 0.0
+
+
+class PageSizer(object):
+    """Number of notes to ask for in the next index page, between low and
+    high. Starts at low, and follows the time and size of full pages, so
+    that a page takes about target_time and holds at most max_bytes."""
+
+    def __init__(self, low, high, target_time, max_bytes):
+        self.low = low
+        self.high = max(low, high)
+        self.target_time = target_time
+        self.max_bytes = max_bytes
+        self.limit = low
+
+    def update(self, seconds, nbytes):
+        """Record a full page of self.limit notes"""
+        scale = self.target_time / max(seconds, 0.001)
+        if nbytes:
+            scale = min(scale, float(self.max_bytes) / nbytes)
+        # one slow page may be a fluke, so change by at most 2x per page
+        scale = min(max(scale, 0.5), 2.0)
+        self.limit = int(min(max(self.limit * scale, self.low), self.high))
+
+
+def _make_state_dir(data_dir):
+    """Make state dir, and make sure git does not pick it up"""
+    state_dir = os.path.join(data_dir, STATE_DIR_NAME)
+    gitignore = os.path.join(state_dir, '.gitignore')
+    # check .gitignore rather than the dir, in case an older version
+    # made the dir without it
+    if os.path.exists(gitignore):
+        return
+    try:
+        os.mkdir(state_dir)
+    except OSError as e:
+        # a waiting run may be making it at the same time
+        if e.errno != errno.EEXIST:
+            raise
+    with open(gitignore, 'w') as f:
+        print >>f, '*'
+
+
+def _try_lock(f):
+    """Lock file without waiting. Returns False if it is locked already"""
+    try:
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def _utf8(name):
+    """Filenames are built from both unicode tags and utf-8 titles; make
+    sure they are all utf-8, so they can be compared"""
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+
+def _md5_file(filename):
+    """md5 hex digest of file contents (runs in a pool worker)"""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # cannot map empty file
+            return hashlib.md5().hexdigest()
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return hashlib.md5(data).hexdigest()
+        finally:
+            data.close()
+
+
+def _batches(iterable, size):
+    """Split iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _prefetch(iterable):
+    """Iterate over iterable in a background thread, one item ahead"""
+    queue = Queue.Queue(maxsize=1)
+    done = object()
+
+    def worker():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+            queue.put((done, None))
+        except:
+            queue.put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=worker, name='prefetch')
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, exc_info = queue.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if item is done:
+            break
+        yield item
+    thread.join()
+
+
 MAX_NAME_LEN = 48
 def sanitize_fname(p):
     """Make string filename-safe"""
@@ -551,8 +2905,332 @@ def sanitize_fname(p):
 
 
 
+def read_config(extra_config=None):
+    """Read the usual config files. Returns (config, names of files read)"""
+    config = ConfigParser.SafeConfigParser()
+    home = os.path.abspath(os.path.expanduser('~'))
+
+    # later config files overwrite earlier files
+    # try a number of alternatives
+    # This list is copied from nvpy: /nvpy/nvpy.py
+    configs = [
+            os.path.join(home, '.simplenote-backup.cfg'),
+            os.path.join(home, 'nvpy.cfg'),
+            os.path.join(home, '.nvpy.cfg'),
+            os.path.join(home, '.nvpy'),
+            os.path.join(home, '.nvpyrc') ]
+    if extra_config is not None:
+        configs.append(extra_config)
+    names = config.read(configs)
+    return config, names
+
+
+def search(opts, query):
+    """search command: print notes matching query. Returns exit status.
+
+    Only reads the index, so it works while a backup is running, and
+    without network access.
+    """
+    data_dir = opts.output
+    if data_dir is None:
+        config, _ = read_config(opts.extra_config)
+        data_dir = os.path.expanduser(config.get('simplenote-backup', 'data-dir'))
+    filename = os.path.join(data_dir, STATE_DIR_NAME, 'search.sqlite')
+    if not os.path.exists(filename):
+        print >>sys.stderr, ('FATAL: No search index in %r, set '
+                             'search-index = yes and run backup' % (data_dir, ))
+        return 2
+    index = SearchIndex(filename)
+    try:
+        results = index.search(query, opts.limit)
+    except sqlite3.OperationalError as e:
+        print >>sys.stderr, 'FATAL: Bad query %r: %s' % (query, e)
+        return 2
+    finally:
+        index.close()
+    for filename, modified, snippet in results:
+        print '%s  %s' % (modified, filename)
+        print '    %s' % ' '.join(snippet.split())
+    return 0 if results else 1
+
+
+def compare(opts, ev_dir, sn_dir=None):
+    """compare command: compare Evernote export with notes. Returns exit
+    status, 0 if all the notes are the same.
+
+    Fingerprints of the word lists are saved in the state dir of sn_dir
+    with the files' mtime/size, so pairs of unchanged files which were the
+    same need not be read at all.
+    """
+    if sn_dir is None:
+        sn_dir = opts.output
+    if sn_dir is None:
+        config, _ = read_config(opts.extra_config)
+        sn_dir = os.path.expanduser(config.get('simplenote-backup', 'data-dir'))
+    state_dir = os.path.join(sn_dir, STATE_DIR_NAME)
+    cache_file = os.path.join(state_dir, 'compare.json')
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = dict()
+
+    def cached(filename, st):
+        rec = cache.get(os.path.abspath(filename).decode('utf-8', 'replace'))
+        if rec is not None and rec[:2] == [st.st_mtime, st.st_size]:
+            return rec[2]
+        return None
+
+    # list of (evernote file, simplenote file or None if missing,
+    # job for _compare_pair or None if known to be the same)
+    pairs = []
+    new_cache = dict()
+    for ef in sorted(glob.glob(os.path.join(ev_dir, '*', '*.stxt'))):
+        sf = os.path.join(sn_dir, os.path.relpath(ef, ev_dir))[:-len('.stxt')] + '.txt'
+        try:
+            est, sst = os.stat(ef), os.stat(sf)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            pairs.append((ef, None, None))
+            continue
+        efp, sfp = cached(ef, est), cached(sf, sst)
+        if efp is not None and efp == sfp:
+            new_cache[os.path.abspath(ef)] = [est.st_mtime, est.st_size, efp]
+            new_cache[os.path.abspath(sf)] = [sst.st_mtime, sst.st_size, sfp]
+            pairs.append((ef, sf, None))
+        else:
+            pairs.append((ef, sf, (ef, sf)))
+
+    jobs = [job for _, _, job in pairs if job is not None]
+    pool = multiprocessing.Pool()
+    try:
+        results = pool.imap(_compare_pair, jobs, COMPARE_CHUNK_SIZE)
+        n_diff = 0
+        for ef, sf, job in pairs:
+            if sf is None:
+                print 'MISSING: %s' % ef
+                n_diff += 1
+                continue
+            if job is not None:
+                diff, records = next(results)
+                for filename, rec in records.items():
+                    new_cache[os.path.abspath(filename)] = rec
+                if diff:
+                    print '\n'.join(diff)
+                    print
+                    n_diff += 1
+                    continue
+            print 'SAME: %s' % ef
+    finally:
+        pool.terminate()
+
+    _make_state_dir(sn_dir)
+    _write_file_atomic(cache_file, json.dumps(new_cache))
+    return 1 if n_diff else 0
+
+
+def _compare_words(filename, title_first):
+    """Words of note text without the title line; utf-8 NBSP counts as a
+    space. Returns (words, os.stat result of file)"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    # simplenote has title in first line, evernote export in the last
+    if title_first:
+        lines = lines[1:]
+    else:
+        lines = lines[:-1]
+    return ' '.join(lines).replace('\xc2\xa0', ' ').split(), st
+
+
+def _compare_pair(job):
+    """Compare word lists of an evernote and a simplenote file (runs in a
+    pool worker). Returns (unified diff lines, or [] if the same,
+    fingerprint records for compare's cache)"""
+    ef, sf = job
+    records = dict()
+    words = []
+    for filename, title_first in [(ef, False), (sf, True)]:
+        file_words, st = _compare_words(filename, title_first)
+        fingerprint = hashlib.md5('\n'.join(file_words)).hexdigest()
+        records[filename] = [st.st_mtime, st.st_size, fingerprint]
+        words.append(file_words)
+    diff = list(difflib.unified_diff(words[0], words[1], ef, sf, lineterm=''))
+    return diff, records
+
+
+def print_journal(opts, after):
+    """journal command: print journal lines with seq > after. Returns exit
+    status."""
+    config, _ = read_config(opts.extra_config)
+    data_dir = opts.output
+    if data_dir is None:
+        data_dir = os.path.expanduser(config.get('simplenote-backup', 'data-dir'))
+    if config.has_option('simplenote-backup', 'journal-file'):
+        filename = os.path.expanduser(
+            config.get('simplenote-backup', 'journal-file'))
+    else:
+        filename = os.path.join(data_dir, STATE_DIR_NAME, 'journal')
+    for rec in Journal(filename).read(after):
+        print json.dumps(rec, separators=(',', ':'))
+    return 0
+
+
+def read_accounts(filename):
+    """Read multi-account file. Returns (jobs, list of (name, config)).
+
+    Each [account NAME] section becomes a separate config, with nvpy options
+    from ACCOUNT_NVPY_OPTIONS, and everything else in simplenote-backup
+    section on top of the file's own [simplenote-backup] section.
+    """
+    accounts = ConfigParser.RawConfigParser()
+    if not accounts.read([filename]):
+        raise Exception('Cannot read accounts file %r' % (filename, ))
+    defaults = []
+    jobs = ACCOUNT_JOBS
+    if accounts.has_section('simplenote-backup'):
+        defaults = accounts.items('simplenote-backup')
+        for key in ACCOUNT_OWN_OPTIONS:
+            if accounts.has_option('simplenote-backup', key):
+                raise Exception('%s must be set in each [account NAME] '
+                                'section, not in [simplenote-backup]' % (key, ))
+        if accounts.has_option('simplenote-backup', 'jobs'):
+            jobs = accounts.getint('simplenote-backup', 'jobs')
+
+    result = []
+    # real path -> (account, option) which uses it
+    used_files = dict()
+    for section in accounts.sections():
+        if not section.startswith('account '):
+            continue
+        name = section[len('account '):].strip()
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('nvpy')
+        config.add_section('simplenote-backup')
+        for key, value in defaults + accounts.items(section):
+            if key in ACCOUNT_NVPY_OPTIONS:
+                ConfigParser.RawConfigParser.set(config, 'nvpy', key, value)
+            elif key != 'jobs':
+                ConfigParser.RawConfigParser.set(config, 'simplenote-backup', key, value)
+        # no default token file here: accounts must not share it
+        for sect, key in (('nvpy', 'sn_username'),
+                          ('simplenote-backup', 'data-dir'),
+                          ('simplenote-backup', 'token-cache-file')):
+            if not config.has_option(sect, key):
+                raise Exception('Account %r: %s missing' % (name, key))
+        for key in ACCOUNT_OWN_OPTIONS:
+            if not config.has_option('simplenote-backup', key):
+                continue
+            path = os.path.realpath(os.path.expanduser(
+                    config.get('simplenote-backup', key)))
+            if path in used_files:
+                raise Exception('Account %r: %s is %r, already used by '
+                                'account %r as %s' % (
+                        (name, key, path) + used_files[path]))
+            used_files[path] = (name, key)
+        result.append((name, config))
+    if not result:
+        raise Exception('No [account NAME] sections in %r' % (filename, ))
+    return jobs, result
+
+
+def _run_account(job):
+    """Back up one account in multi-account mode (runs in a pool worker).
+
+    Never raises: the failures are reported in the result, so that the other
+    accounts still get backed up.
+    """
+    name, config, opts = job
+    start = time.time()
+    result = dict(name=name, status='ok', error=None, changes=[])
+    socket.setdefaulttimeout(60)
+    sn = None
+    try:
+        sn = SimplenoteDownloader(config=config,
+                                  verbose=opts['verbose'],
+                                  rescan=opts['rescan'],
+                                  verify=opts['verify'],
+                                  lock_wait=opts['wait'],
+                                  log_prefix='[%s] ' % name)
+        if opts['incremental'] is not None:
+            sn.incremental = opts['incremental']
+        if opts['git']:
+            sn.verify_git()
+        success = False
+        try:
+            sn.sync_and_write(pretend=opts['pretend'])
+            if opts['git']:
+                sn.maybe_checkin_to_git(pretend=opts['pretend'])
+            success = True
+        finally:
+            sn.write_metrics(success)
+        result['changes'] = sn.changes
+    except RunQueuedError as e:
+        result.update(status='queued', error=str(e))
+    except OutputBusyError as e:
+        result.update(status='busy', error=str(e))
+    # any failure of one account must not stop the others; it is reported
+    # in the summary and the exit status instead
+    except Exception as e:  # pylint: disable=broad-except
+        traceback.print_exc()
+        # full traceback is above, first line is enough for the summary
+        result.update(status='failed', error='%s: %s' % (
+                type(e).__name__, (str(e).splitlines() or [''])[0]))
+    finally:
+        if sn is not None:
+            sn.close()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def run_accounts(filename, jobs, opts):
+    """Back up all accounts from file, print summary. Returns exit status"""
+    file_jobs, accounts = read_accounts(filename)
+    jobs = min(jobs or file_jobs, len(accounts))
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        # get() with timeout, so that Ctrl-C works
+        results = pool.map_async(
+            _run_account, [(name, config, opts) for name, config in accounts],
+            chunksize=1).get(365 * 86400)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    width = max(len(r['name']) for r in results)
+    for r in results:
+        if r['status'] == 'ok':
+            info = '%d changes' % len(r['changes'])
+        else:
+            info = r['error']
+        print '%-*s  %-6s %6.1fs  %s' % (width, r['name'], r['status'],
+                                         r['seconds'], info)
+    n_bad = sum(1 for r in results if r['status'] not in ('ok', 'queued'))
+    print '%d accounts, %d failed' % (len(results), n_bad)
+
+    if opts['print_changes']:
+        import pprint
+        pprint.pprint(dict((r['name'], r['changes']) for r in results))
+
+    if n_bad == 0:
+        return 0
+    # like the single-account mode: 2 if the only problem was a busy dir
+    if all(r['status'] == 'busy' for r in results
+           if r['status'] not in ('ok', 'queued')):
+        return 2
+    return 1
+
+
 def main():
-    parser = optparse.OptionParser(usage='%prog [opts]',
+    parser = optparse.OptionParser(usage='%prog [opts]\n'
+                                   '       %prog [opts] search QUERY\n'
+                                   '       %prog [opts] restore [GIT-REV]\n'
+                                   '       %prog [opts] compare EVERNOTE-DIR [SIMPLENOTE-DIR]\n'
+                                   '       %prog [opts] journal [SEQ]',
                                    description=__doc__)
     parser.format_description = lambda _: parser.description.lstrip()
 
@@ -570,15 +3248,104 @@ def main():
                       ' git repo)')
     parser.add_option('--print-changes', action='store_true',
                       help='Print changes overview to stdout')
+    parser.add_option('-i', '--incremental', action='store_true', default=None,
+                      help='Only download notes changed since last run '
+                      '(may be specified in config)')
+    parser.add_option('--full', action='store_false', dest='incremental',
+                      help='Download all notes, even if incremental mode is '
+                      'enabled in config')
+    parser.add_option('--rescan', action='store_true',
+                      help='Ignore saved manifest and re-read all files in '
+                      'output dir')
+    parser.add_option('--verify', action='store_const', const='changed',
+                      help='Check md5 of note files which changed since '
+                      'they were last checked')
+    parser.add_option('--verify-all', action='store_const', const='all',
+                      dest='verify',
+                      help='Check md5 of all note files')
+    parser.add_option('--metrics-json', metavar='FILE',
+                      help='Write timings and counters of the run to FILE '
+                      '(may be specified in config)')
+    parser.add_option('--metrics-prom', metavar='FILE',
+                      help='Write timings and counters for Prometheus '
+                      'textfile collector (may be specified in config)')
+    parser.add_option('--wait', type='float', metavar='SECONDS',
+                      help='If another instance is running, wait up to '
+                      'SECONDS for it to finish (may be specified in config)')
+    parser.add_option('--daemon', action='store_true',
+                      help='Keep running, and sync whenever notes change '
+                      'on server')
+    parser.add_option('--export', metavar='DIR',
+                      help='Do not sync, write notes from sqlite storage '
+                      'to DIR as .txt/.json files')
+    parser.add_option('--limit', type='int', default=SEARCH_LIMIT,
+                      help='With search, max number of notes to show '
+                      '(default %default)')
+    parser.add_option('--accounts', metavar='FILE',
+                      help='Back up all accounts listed in FILE')
+    parser.add_option('-j', '--jobs', type='int',
+                      help='With --accounts, number of accounts to back up '
+                      'at once (default %d)' % ACCOUNT_JOBS)
 
     opts, args = parser.parse_args()
-    if len(args):
-        parser.error('No args accepted')
+    command = args.pop(0) if args else None
+    if command == 'search':
+        if not args:
+            parser.error('search needs a query')
+        return search(opts, ' '.join(args))
+    elif command == 'compare':
+        if len(args) not in (1, 2):
+            parser.error('compare needs evernote dir, and optionally '
+                         'simplenote dir')
+        return compare(opts, *args)
+    elif command == 'journal':
+        if len(args) > 1:
+            parser.error('journal takes at most one sequence number')
+        try:
+            after = int(args[0]) if args else 0
+        except ValueError:
+            parser.error('Bad sequence number %r' % (args[0], ))
+        return print_journal(opts, after)
+    elif command == 'restore':
+        if len(args) > 1:
+            parser.error('restore takes at most one git revision')
+        if opts.daemon or opts.accounts:
+            parser.error('restore cannot be used with --daemon or --accounts')
+    elif command is not None:
+        parser.error('Unknown command %r' % (command, ))
+    if opts.daemon and opts.pretend:
+        parser.error('--daemon cannot be used with --pretend')
+    if opts.accounts:
+        for name in ('extra_config', 'output', 'daemon',
+                     'metrics_json', 'metrics_prom'):
+            if getattr(opts, name):
+                parser.error('--%s cannot be used with --accounts'
+                             % name.replace('_', '-'))
+        return run_accounts(opts.accounts, opts.jobs, dict(
+                verbose=opts.verbose, rescan=opts.rescan, verify=opts.verify,
+                wait=opts.wait, incremental=opts.incremental, git=opts.git,
+                pretend=opts.pretend, print_changes=opts.print_changes))
+    elif opts.jobs:
+        parser.error('--jobs can only be used with --accounts')
+
+    lock_wait = opts.wait
+    if command == 'restore' or opts.export:
+        if opts.wait:
+            parser.error('--wait only applies to backups')
+        # a queued restore would never run
+        lock_wait = 0
 
     try:
         sn = SimplenoteDownloader(extra_config=opts.extra_config,
                                   verbose=opts.verbose,
-                                  data_dir=opts.output)
+                                  data_dir=opts.output,
+                                  rescan=opts.rescan,
+                                  verify=opts.verify,
+                                  lock_wait=lock_wait)
+    except RunQueuedError as e:
+        if opts.verbose:
+            print >>sys.stderr, 'Not running: %s' % e
+        return 0
     except OutputBusyError as e:
         print >>sys.stderr, 'FATAL: %s' % e
         return 2
@@ -586,13 +3353,36 @@ def main():
     # Set longish timeout for all HTTP requiests
     socket.setdefaulttimeout(60)
 
+    if opts.incremental is not None:
+        sn.incremental = opts.incremental
+    if opts.metrics_json:
+        sn.metrics_json = opts.metrics_json
+    if opts.metrics_prom:
+        sn.metrics_prom = opts.metrics_prom
+
+    if opts.export:
+        sn.export(opts.export)
+        return 0
+
+    if command == 'restore':
+        return sn.restore(rev=args[0] if args else None, pretend=opts.pretend)
+
     if opts.git:
         sn.verify_git()
-    sn.sync()
-    sn.write_files(pretend=opts.pretend)
 
-    if opts.git:
-        sn.maybe_checkin_to_git(pretend=opts.pretend)
+    if opts.daemon:
+        sn.run_daemon(git=opts.git, print_changes=opts.print_changes)
+        return 0
+
+    success = False
+    try:
+        sn.sync_and_write(pretend=opts.pretend)
+
+        if opts.git:
+            sn.maybe_checkin_to_git(pretend=opts.pretend)
+        success = True
+    finally:
+        sn.write_metrics(success)
 
     if opts.print_changes:
         import pprint
@@ -0,0 +1,508 @@
+#!/usr/bin/python -B
+"""simplenote-bench --- time simplenote-backup against a fake Simperium server
+
+Starts a local HTTP server which pretends to be Simperium (auth, index, item
+and changes endpoints), fills it with a synthetic bucket, and times the
+backup phases for each requested bucket size:
+
+  cold     - empty data dir, everything is downloaded and written
+  nochange - second run, nothing changed on server
+  delta    - some notes modified, added and deleted on server
+  restore  - all notes deleted on server, then uploaded again from the
+             data dir with the restore command (--throttle makes the
+             server refuse some uploads with 429, as when rate limited)
+
+For each scenario, the downloader setup (config, token, reading existing
+files), sync_and_write() and maybe_checkin_to_git() are timed separately,
+as the program runs them. The downloader's own phase times (index pages,
+writes, flushes, ...) are reported under "phases"; phases may run in
+several threads at once, so they can add up to more than sync_and_write.
+Results are printed as JSON, so they can be stored and compared between
+versions.
+
+Example:
+  ./simplenote-bench.py -n 1000 -n 10000 --delta 20 -o bench.json
+  ./simplenote-bench.py -n 1000 --set incremental=yes --set fetch-threshold=0
+  ./simplenote-bench.py -n 1000 --throttle 0.05
+"""
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import argparse
+import bisect
+import gzip
+import imp
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urlparse
+
+sn_backup = imp.load_source(
+    'simplenote_backup',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'simplenote-backup.py'))
+
+TOKEN = 'bench-token'
+USERNAME = 'bench@example.com'
+
+# default page size of the fake index
+DEFAULT_LIMIT = 100
+
+# (size, weight) of synthetic note contents
+CONTENT_SIZES = [(40, 30), (400, 40), (4000, 25), (40000, 5)]
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+class FakeBucket(object):
+    """Synthetic bucket. Note contents are generated from (key, version) on
+    demand, so only versions are kept in memory."""
+
+    def __init__(self, size, seed):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.cv = 0
+        # key -> [version, cv of last change]
+        self.notes = dict()
+        # (key, version) -> note data uploaded by clients
+        self.uploaded = dict()
+        # fixed for the life of the bucket, so that note contents do not
+        # change when notes are added or deleted
+        self.n_titles = max(size // 4, 1)
+        self.keys = []
+        for _ in range(size):
+            self.add(keep_sorted=False)
+        self.keys.sort()
+
+    def _new_key(self):
+        return '%032x' % self.rng.getrandbits(128)
+
+    def add(self, keep_sorted=True):
+        key = self._new_key()
+        self.cv += 1
+        self.notes[key] = [1, self.cv]
+        if keep_sorted:
+            bisect.insort(self.keys, key)
+        else:
+            self.keys.append(key)
+
+    def modify(self, key):
+        self.cv += 1
+        self.notes[key][0] += 1
+        self.notes[key][1] = self.cv
+
+    def delete(self, key):
+        self.cv += 1
+        del self.notes[key]
+        del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def put(self, key, data):
+        """Store note data uploaded by a client, as a new version"""
+        self.cv += 1
+        if key in self.notes:
+            self.notes[key][0] += 1
+            self.notes[key][1] = self.cv
+        else:
+            self.notes[key] = [1, self.cv]
+            bisect.insort(self.keys, key)
+        self.uploaded[(key, self.notes[key][0])] = data
+
+    def mutate(self, modify=0, add=0, delete=0):
+        keys = self.rng.sample(self.keys, min(len(self.keys), modify + delete))
+        for key in keys[:modify]:
+            self.modify(key)
+        for key in keys[modify:]:
+            self.delete(key)
+        for _ in range(add):
+            self.add()
+
+    def data(self, key, version):
+        if (key, version) in self.uploaded:
+            return self.uploaded[(key, version)]
+        rng = random.Random('%s/%s/%d' % (self.seed, key, version))
+        size = weighted_choice(rng, CONTENT_SIZES)
+        # few distinct titles, so that there are plenty of collisions
+        title = 'Note %d' % rng.randrange(self.n_titles)
+        words = []
+        length = len(title)
+        while length < size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        content = title + '\n' + ' '.join(words)
+        tags = []
+        if rng.random() < 0.2:
+            tags.append('/project%d' % rng.randrange(10))
+        if rng.random() < 0.3:
+            tags.append('tag%d' % rng.randrange(50))
+        system_tags = []
+        if rng.random() < 0.05:
+            system_tags.append('pinned')
+        created = 1.3e9 + rng.randrange(10 ** 8)
+        return dict(content=content, tags=tags, systemTags=system_tags,
+                    deleted=rng.random() < 0.03,
+                    creationDate=created,
+                    modificationDate=created + version * 60,
+                    shareURL='', publishURL='')
+
+
+def weighted_choice(rng, choices):
+    total = sum(weight for _, weight in choices)
+    pick = rng.uniform(0, total)
+    for value, weight in choices:
+        pick -= weight
+        if pick <= 0:
+            return value
+    return choices[-1][0]
+
+
+class FakeSimperiumHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer replies, flushed after each request. Unbuffered writes send
+    # each header line separately, which on a kept-alive connection waits
+    # for delayed ACKs.
+    wbufsize = -1
+    # one handler per connection; counted on first API request
+    counted = False
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # like real servers on kept-alive connections; otherwise the tail
+        # of each reply can wait for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        body = self._body()
+        bucket = self.server.bucket
+        if url.path.endswith('/authorize/'):
+            return self._reply(200, dict(access_token=TOKEN, username=USERNAME))
+        if url.path == '/_bench/mutate':
+            bucket.mutate(**json.loads(body))
+            return self._reply(200, dict(current=str(bucket.cv)))
+        if url.path == '/_bench/stats':
+            stats = self.server.stats
+            self.server.stats = FakeSimperiumServer.new_stats()
+            return self._reply(200, stats)
+        if url.path == '/_bench/throttle':
+            self.server.throttle = json.loads(body)['fraction']
+            return self._reply(200, dict())
+
+        # /1/<app>/<bucket>/i/<key>
+        parts = url.path.strip('/').split('/')
+        if len(parts) == 5 and parts[3] == 'i':
+            self._count_request()
+            if self.headers.get('X-Simperium-Token') != TOKEN:
+                return self._reply(401, dict())
+            if self.server.rng.random() < self.server.throttle:
+                self.server.stats['throttled'] += 1
+                self.send_response(429)
+                self.send_header('Retry-After', '0.1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            bucket.put(parts[4], json.loads(body))
+            return self._reply(200, dict())
+        self._reply(404, dict())
+
+    def _count_request(self):
+        self.server.stats['requests'] += 1
+        if not self.counted:
+            self.server.stats['connections'] += 1
+            self.counted = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        bucket = self.server.bucket
+        self._count_request()
+        if self.headers.get('X-Simperium-Token') != TOKEN:
+            return self._reply(401, dict())
+
+        # /1/<app>/<bucket>/index
+        if len(parts) == 4 and parts[3] == 'index':
+            keys = bucket.keys
+            if query.get('since'):
+                since = int(query['since'])
+                keys = [key for key in keys if bucket.notes[key][1] > since]
+            start = int(query.get('mark') or 0)
+            limit = int(query.get('limit') or DEFAULT_LIMIT)
+            index = []
+            for key in keys[start:start + limit]:
+                version = bucket.notes[key][0]
+                item = dict(id=key, v=version)
+                if query.get('data'):
+                    item['d'] = bucket.data(key, version)
+                index.append(item)
+            ret = dict(index=index, current=str(bucket.cv))
+            if start + limit < len(keys):
+                ret['mark'] = str(start + limit)
+            return self._send_counted(ret)
+
+        # /1/<app>/<bucket>/i/<key>[/v/<version>]
+        if len(parts) in (5, 7) and parts[3] == 'i':
+            key = parts[4]
+            if key not in bucket.notes:
+                return self._reply(404, dict())
+            version = bucket.notes[key][0]
+            if len(parts) == 7:
+                version = int(parts[6])
+            return self._send_counted(bucket.data(key, version))
+
+        # /1/<app>/<bucket>/changes -- no long polling here
+        if len(parts) == 4 and parts[3] == 'changes':
+            since = int(query.get('cv') or 0)
+            return self._send_counted([
+                    dict(id=key, cv=str(cv), o='M')
+                    for key, (_, cv) in sorted(bucket.notes.items())
+                    if cv > since])
+
+        self._reply(404, dict())
+
+    def _send_counted(self, obj):
+        body = json.dumps(obj)
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            buf = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1)
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+        self.server.stats['bytes'] += len(body)
+        self.send_response(200)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSimperiumServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bucket):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeSimperiumHandler)
+        self.bucket = bucket
+        self.stats = self.new_stats()
+        # fraction of uploads refused with 429
+        self.throttle = 0.0
+        self.rng = random.Random(0)
+
+    @staticmethod
+    def new_stats():
+        return dict(requests=0, bytes=0, connections=0, throttled=0)
+
+
+def _serve(size, seed, conn):
+    server = FakeSimperiumServer(FakeBucket(size, seed))
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(size, seed):
+    """Start fake server in a separate process, so it does not compete
+    with the benchmark for the GIL. Returns (process, port)"""
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_serve, args=(size, seed, child))
+    proc.daemon = True
+    proc.start()
+    return proc, parent.recv()
+
+
+def server_call(port, path, args=None):
+    import urllib2
+    resp = urllib2.urlopen('http://127.0.0.1:%d%s' % (port, path),
+                           json.dumps(args or {}))
+    return json.loads(resp.read())
+
+
+def run_scenario(config_file, data_dir, verbose, git):
+    """Run one backup, return dict of phase -> seconds"""
+    times = dict()
+    t0 = time.time()
+    sn = sn_backup.SimplenoteDownloader(extra_config=config_file,
+                                        verbose=verbose, data_dir=data_dir)
+    t1 = time.time()
+    times['setup'] = t1 - t0
+    sn.sync_and_write()
+    t2 = time.time()
+    times['sync_and_write'] = t2 - t1
+    if git:
+        sn.maybe_checkin_to_git()
+        times['git'] = time.time() - t2
+    times['total'] = time.time() - t0
+    times['changes'] = len(sn.changes)
+    times['phases'] = dict((name, seconds) for name, (calls, seconds, _)
+                           in sn.metrics.phases.items())
+    sn.close()
+    return times
+
+
+def run_restore(config_file, data_dir, verbose):
+    """Restore all notes from data dir, return dict of phase -> seconds"""
+    times = dict()
+    t0 = time.time()
+    sn = sn_backup.SimplenoteDownloader(extra_config=config_file,
+                                        verbose=verbose, data_dir=data_dir)
+    t1 = time.time()
+    times['setup'] = t1 - t0
+    sn.restore()
+    times['restore'] = time.time() - t1
+    times['total'] = time.time() - t0
+    # uploads refused with 429 are timed as uploads too
+    times['changes'] = (sn.metrics.phases.get('upload', [0])[0] -
+                        sn.metrics.counters.get('throttled', 0))
+    times['phases'] = dict((name, seconds) for name, (calls, seconds, _)
+                           in sn.metrics.phases.items())
+    sn.close()
+    return times
+
+
+def bench_size(size, args):
+    proc, port = start_server(size, args.seed)
+    work_dir = tempfile.mkdtemp(prefix='simplenote-bench-')
+    results = []
+    try:
+        data_dir = os.path.join(work_dir, 'data')
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, sn_backup.MAGIC_NAME), 'w') as f:
+            print >>f, USERNAME
+        if args.git:
+            for cmd in [['git', 'init', '-q'],
+                        ['git', 'config', 'user.name', 'bench'],
+                        ['git', 'config', 'user.email', 'bench@example.com'],
+                        # background gc would race with cleanup
+                        ['git', 'config', 'gc.auto', '0']]:
+                subprocess.check_call(cmd, cwd=data_dir)
+
+        config_file = os.path.join(work_dir, 'bench.cfg')
+        with open(config_file, 'w') as f:
+            print >>f, '[nvpy]'
+            print >>f, 'sn_username = %s' % USERNAME
+            print >>f, 'sn_password = bench'
+            print >>f, '[simplenote-backup]'
+            print >>f, 'token-cache-file = %s' % os.path.join(work_dir, 'token')
+            print >>f, 'simperium-api-host = 127.0.0.1:%d' % port
+            print >>f, 'simperium-auth-host = 127.0.0.1:%d' % port
+            print >>f, 'simperium-scheme = http'
+            for setting in args.set:
+                print >>f, '%s = %s' % tuple(setting.split('=', 1))
+
+        # do not pick up user's own config files
+        os.environ['HOME'] = work_dir
+
+        for scenario in ['cold', 'nochange', 'delta', 'restore']:
+            if scenario == 'delta':
+                server_call(port, '/_bench/mutate', dict(
+                        modify=args.delta, add=args.delta // 2 + 1,
+                        delete=args.delta // 4 + 1))
+            if scenario == 'restore':
+                # account wiped: every note is gone
+                server_call(port, '/_bench/mutate', dict(delete=2 * size))
+                server_call(port, '/_bench/throttle', dict(fraction=args.throttle))
+            server_call(port, '/_bench/stats')
+            if scenario == 'restore':
+                times = run_restore(config_file, data_dir, args.verbose)
+            else:
+                times = run_scenario(config_file, data_dir, args.verbose, args.git)
+            stats = server_call(port, '/_bench/stats')
+            result = dict(notes=size, scenario=scenario,
+                          requests=stats['requests'],
+                          connections=stats['connections'],
+                          throttled=stats['throttled'],
+                          bytes_sent=stats['bytes'], **times)
+            results.append(result)
+            print >>sys.stderr, '%8d notes %-8s %7.2f sec total (%s)' % (
+                size, scenario, times['total'],
+                ', '.join('%s %.2f' % (k, times[k])
+                          for k in ['setup', 'sync_and_write', 'restore', 'git']
+                          if k in times))
+    finally:
+        proc.terminate()
+        if args.keep:
+            print >>sys.stderr, 'Data kept in %r' % work_dir
+        else:
+            shutil.rmtree(work_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-n', '--notes', type=int, action='append', metavar='N',
+        help='Bucket size to test, may be given several times (default 1000)')
+    parser.add_argument(
+        '--delta', type=int, default=10, metavar='N',
+        help='Number of notes to modify in delta scenario (default 10)')
+    parser.add_argument(
+        '--seed', type=int, default=1, help='Random seed for the bucket')
+    parser.add_argument(
+        '--throttle', type=float, default=0.0, metavar='FRACTION',
+        help='In restore scenario, refuse this fraction of uploads with 429 '
+        '(default 0)')
+    parser.add_argument(
+        '--set', action='append', default=[], metavar='OPT=VALUE',
+        help='Set simplenote-backup config option, may be repeated')
+    parser.add_argument(
+        '--no-git', dest='git', action='store_false',
+        help='Do not time git commits')
+    parser.add_argument(
+        '-k', '--keep', action='store_true',
+        help='Keep the temporary data dir')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        help='Write JSON results to this file (default stdout)')
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help='Verbosity of simplenote-backup')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.notes or [1000]:
+        results += bench_size(size, args)
+
+    report = dict(
+        time=time.strftime('%FT%TZ', time.gmtime()),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        settings=args.set, delta=args.delta, seed=args.seed,
+        throttle=args.throttle,
+        results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True, separators=(',', ': '))
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+        print
+
+
+if __name__ == '__main__':
+    main()